@@ -2,30 +2,24 @@
 # cython: wraparound=False
 # cython: nonecheck=False
 # cython: cdivision=True
+# distutils: extra_compile_args = -fopenmp
+# distutils: extra_link_args = -fopenmp
 
 from __future__ import division
 import numpy as np
 cimport numpy as np
 cimport libc.math
-from libc.math cimport fabs, fma, INFINITY, isfinite
+from libc.math cimport fabs, fma, INFINITY, NAN, isfinite
+from libc.stdlib cimport malloc, calloc, free
+from cython.parallel cimport parallel, prange
+from scipy.linalg.cython_lapack cimport dgebal, dhseqr
 
 cimport cython
 
-from numpy.polynomial.polynomial import Polynomial as Poly
-
-cdef double poly_eval_verbose(np.ndarray[np.float64_t, ndim=1] coef, double x):
-    cdef double y = 0
-    cdef int k, m = coef.shape[0] - 1
-    for k in range(m, -1, -1):
-        y = fma(y, x, coef[k])  # y * x + a_k
-        print k, y, x, coef[k]
-
-    return y
-
-cdef double poly_eval(np.ndarray[np.float64_t, ndim=1] coef, double x):
+cdef inline double poly_eval(const double *coef, int n_coef, double x) nogil:
     cdef double y = 0
-    cdef int k, m = coef.shape[0] - 1
-    for k in range(m, -1, -1):
+    cdef int k
+    for k in range(n_coef - 1, -1, -1):
         y = fma(y, x, coef[k])  # y * x + a_k
 
     return y
@@ -33,6 +27,87 @@ cdef double poly_eval(np.ndarray[np.float64_t, ndim=1] coef, double x):
 cdef np.ndarray[np.float64_t, ndim=1] deriv(np.ndarray[np.float64_t, ndim=1] g_coef):
     return g_coef[1:] * np.arange(1, g_coef.shape[0])
 
+# Layout of t_i_k's stats array: solve counters, then a histogram of the
+# Newton iterations taken from each starting t (0 .. NEWTON_ITERS).
+cdef enum:
+    STAT_SOLVES = 0     # find_t calls (two per point on a split surface)
+    STAT_COLD = 1       # solves with no starting t (always solved by roots)
+    STAT_FALLBACKS = 2  # solves that fell back to companion-matrix roots
+    STAT_ESCAPES = 3    # solves that needed the escape hatch
+    STAT_BIG_YS = 4     # points left with residual > 1e-4
+    STAT_ITERS = 5
+    NEWTON_ITERS = 30
+
+SOLVES, COLD, FALLBACKS, ESCAPES, BIG_YS, ITERS = \
+    STAT_SOLVES, STAT_COLD, STAT_FALLBACKS, STAT_ESCAPES, STAT_BIG_YS, STAT_ITERS
+MAX_NEWTON_ITERS = NEWTON_ITERS
+STATS_LEN = STAT_ITERS + NEWTON_ITERS + 1
+
+# One thread's counters, merged into stats once its points are done.
+cdef struct SolveStats:
+    long solves
+    long cold
+    long fallbacks
+    long escapes
+    long iters[NEWTON_ITERS + 1]
+
+# Scratch space for one thread's companion-matrix root solve, degree <= n.
+cdef struct RootBuffers:
+    double *s_coef  # n + 1
+    double *H       # n * n, column-major
+    double *scale   # n
+    double *wr      # n
+    double *wi      # n
+    double *work    # n
+
+cdef double *alloc_buffers(RootBuffers *buf, int n) nogil:
+    cdef double *block = <double *> malloc(sizeof(double) * (n * n + 5 * n + 1))
+    buf.s_coef = block
+    buf.H = block + n + 1
+    buf.scale = buf.H + n * n
+    buf.wr = buf.scale + n
+    buf.wi = buf.wr + n
+    buf.work = buf.wi + n
+    return block
+
+# Real roots of sum(coef[k] u^k), k < n_coef, as eigenvalues of the companion
+# matrix (upper Hessenberg, so scale-only balance + dhseqr; permuting would
+# break the Hessenberg form; no Python objects). Roots
+# are written to buf.wr; buf.wi holds imaginary parts. Returns root count.
+cdef int companion_roots(double *coef, int n_coef, RootBuffers *buf) nogil:
+    cdef int d = n_coef - 1
+    cdef int i, j, ilo, ihi, info, one = 1, lwork
+    cdef char job_bal = b'S', job = b'E', compz = b'N'
+    cdef double lead
+
+    while d > 0 and coef[d] == 0.:
+        d -= 1
+
+    if d <= 0:
+        return 0
+    if d == 1:
+        buf.wr[0] = -coef[0] / coef[1]
+        buf.wi[0] = 0.
+        return 1
+
+    lead = coef[d]
+    for j in range(d):
+        for i in range(d):
+            buf.H[i + j * d] = 0.
+    for i in range(d - 1):
+        buf.H[(i + 1) + i * d] = 1.
+    for i in range(d):
+        buf.H[i + (d - 1) * d] = -coef[i] / lead
+
+    lwork = d
+    dgebal(&job_bal, &d, buf.H, &d, &ilo, &ihi, buf.scale, &info)
+    if info != 0: return 0
+    dhseqr(&job, &compz, &d, &ilo, &ihi, buf.H, &d, buf.wr, buf.wi,
+           buf.H, &one, buf.work, &lwork, &info)
+    if info != 0: return 0
+
+    return d
+
 # solve: g([R(pt - Of)]_x - T) = [R(pt - Of)]_z
 #  g(ray[0] * t - ROf_x) = ray[2] * t - ROf_z
 #  g(t) = h(w * t) / w
@@ -46,82 +121,77 @@ cdef np.ndarray[np.float64_t, ndim=1] deriv(np.ndarray[np.float64_t, ndim=1] g_c
 #         = h'(u) * Rp_x - Rp_z
 #
 #   s(u)  = h(u) / w - (Rp_z / Rp_x * (u / w + ROf_x + T) - ROf_z)
-cdef double find_t(np.ndarray[np.float64_t, ndim=1] h_coef,
-                   np.ndarray[np.float64_t, ndim=1] hp_coef,
+cdef double find_t(const double *h_coef, const double *hp_coef, int n_coef,
                    double w, double T,
                    double ROf_x, double ROf_z,
                    double Rp_x, double Rp_z,
-                   double t0):
-    cdef int done
-    cdef double t, y, yp, t_out, u_minus, u_plus, y_minus, y_plus, best_t
-    cdef int j
-    cdef np.ndarray[np.float64_t, ndim=1] s_coef, roots_t, roots_t_neg
-    cdef np.ndarray roots_u
+                   double t0, RootBuffers *buf, SolveStats *st) nogil:
+    cdef int done, n_roots, n_iter
+    cdef double t = NAN, y = INFINITY, yp, t_out, u, u_minus, u_plus
+    cdef double y_minus, y_plus, best_t, root_t
+    cdef int j, k
 
     if not isfinite(T):
         T = 0.
 
+    st.solves += 1
     done = False
     if isfinite(t0):
         t = t0
-        for j in range(30):
+        n_iter = 0
+        for j in range(NEWTON_ITERS):
             u = w * (Rp_x * t - ROf_x - T)
-            y = poly_eval(h_coef, u) / w - fma(Rp_z, t, -ROf_z)
+            y = poly_eval(h_coef, n_coef, u) / w - fma(Rp_z, t, -ROf_z)
             if fabs(y) < 1e-6:
-                # print j
                 break
-            yp = fma(poly_eval(hp_coef, u), Rp_x, -Rp_z)
+            yp = fma(poly_eval(hp_coef, n_coef - 1, u), Rp_x, -Rp_z)
             t -= y / yp
+            n_iter += 1
+        st.iters[n_iter] += 1
 
         u_minus = w * (Rp_x * t * 0.99 - ROf_x - T)
-        y_minus = poly_eval(h_coef, u_minus) / w - fma(Rp_z, t * 0.99, -ROf_z)
+        y_minus = poly_eval(h_coef, n_coef, u_minus) / w - fma(Rp_z, t * 0.99, -ROf_z)
         u_plus = w * (Rp_x * t * 0.01 - ROf_x - T)
-        y_plus = poly_eval(h_coef, u_plus) / w - fma(Rp_z, t * 0.01, -ROf_z)
+        y_plus = poly_eval(h_coef, n_coef, u_plus) / w - fma(Rp_z, t * 0.01, -ROf_z)
         if y_minus * y_plus > 0 and fabs(y) < 1e-6:  # same sign, not obv an intermediate root
             done = True
-        else:
-            pass  # print 'warning: need to check all roots!'
+
+    else:
+        st.cold += 1
 
     if not done:
-        # print 'checking all roots...'
-        s_coef = h_coef / w
-        s_coef[1] -= Rp_z / Rp_x / w
-        s_coef[0] += ROf_z - Rp_z / Rp_x * (ROf_x + T)
-
-        s_poly = Poly(s_coef)
-        roots_u = s_poly.roots()
-        roots_t = (roots_u[abs(roots_u.imag) < 1e-7].real / w + ROf_x + T) / Rp_x
-        roots_t_neg = roots_t[roots_t < 0]
-        if roots_t_neg.shape[0] > 0:
-            t = -INFINITY
-            for j in range(roots_t_neg.shape[0]):
-                if roots_t_neg[j] > t:
-                    t = roots_t_neg[j]
-
-        # for j in range(10):
-        #     u = w * (Rp_x * t - ROf_x - T)
-        #     y = poly_eval(h_coef, u) / w - fma(Rp_z, t, -ROf_z)
-        #     if fabs(y) < 1e-4:
-        #         # print j
-        #         break
-        #     yp = fma(poly_eval(hp_coef, u), Rp_x, -Rp_z)
-        #     t -= y / yp
+        st.fallbacks += 1
+        # check all roots: largest negative t.
+        for k in range(n_coef):
+            buf.s_coef[k] = h_coef[k] / w
+        buf.s_coef[1] -= Rp_z / Rp_x / w
+        buf.s_coef[0] += ROf_z - Rp_z / Rp_x * (ROf_x + T)
+
+        n_roots = companion_roots(buf.s_coef, n_coef, buf)
+        best_t = -INFINITY
+        for k in range(n_roots):
+            if fabs(buf.wi[k]) < 1e-7:
+                root_t = (buf.wr[k] / w + ROf_x + T) / Rp_x
+                if root_t < 0 and root_t > best_t:
+                    best_t = root_t
+        if isfinite(best_t):
+            t = best_t
 
     t_out = t
 
     if not isfinite(t_out):
-        # print 'escape hatch'
+        # escape hatch
+        st.escapes += 1
         best_t = -INFINITY
-        for t0 in np.linspace(0, -2.0, 10):
-            t = t0
+        for k in range(10):
+            t = -2.0 * k / 9
             for j in range(50):
                 u = w * (Rp_x * t - ROf_x - T)
-                y = poly_eval(h_coef, u) / w - fma(Rp_z, t, -ROf_z)
+                y = poly_eval(h_coef, n_coef, u) / w - fma(Rp_z, t, -ROf_z)
                 if fabs(y) < 1e-8: break
-                yp = fma(poly_eval(hp_coef, u), Rp_x, -Rp_z)
+                yp = fma(poly_eval(hp_coef, n_coef - 1, u), Rp_x, -Rp_z)
                 t -= y / yp
 
-            # print('{: .4f} {: .4f} {: .8f}'.format(t0, t, y))
             if (best_t > 0 and t < 0) or fabs(t) < fabs(best_t) + 1e-5:
                 best_t = t
 
@@ -131,20 +201,35 @@ cdef double find_t(np.ndarray[np.float64_t, ndim=1] h_coef,
 
 # g(x) = 1/w h(wx)
 # g'(x) = h'(wx)
+# f: focal length in pixels; points lie on the focal plane z = -f.
+# stats: optional int64 array of STATS_LEN the solve counters are added to;
+# without it, unsolved points are reported on stdout.
 def t_i_k(np.ndarray[np.float64_t, ndim=2] R,
           g,
           np.ndarray[np.float64_t, ndim=2] points,
-          np.ndarray[np.float64_t, ndim=1] t0s):
+          np.ndarray[np.float64_t, ndim=1] t0s,
+          double f=3270.5,
+          np.ndarray[np.int64_t, ndim=1] stats=None):
 
     cdef np.ndarray[np.float64_t, ndim=1] ts, Of, ROf
     cdef np.ndarray[np.float64_t, ndim=1] hl_coef, hlp_coef, hr_coef, hrp_coef
     cdef np.ndarray[np.float64_t, ndim=2] rays
 
-    cdef double f = 3270.5
-    cdef double ROf_x, ROf_y, ROf_z, Rp_x, Rp_y, Rp_z
-
-    cdef int n, i, big_ys
-    cdef double t, y, u, t0, big_ys_sum, tl, tr, yl = INFINITY, yr = INFINITY
+    cdef double[::1] ts_v, t0s_v, rays_x, rays_z
+    cdef double *hl
+    cdef double *hlp
+    cdef double *hr = NULL
+    cdef double *hrp = NULL
+    cdef double *block
+    cdef RootBuffers *buf
+    cdef SolveStats *st
+    cdef np.int64_t[::1] stats_v
+    cdef int have_stats = stats is not None
+
+    cdef double ROf_x, ROf_z, Rp_x, Rp_z
+
+    cdef int n, i, k, n_coef, big_ys, bad_ts
+    cdef double t, y, u, big_ys_sum, tl, tr, xl, xr, yr
     cdef double w, T
 
     cdef int dual = g.split()
@@ -182,62 +267,89 @@ def t_i_k(np.ndarray[np.float64_t, ndim=2] R,
         ts = ROf_z / rays[2]
         return ts, ts * rays - ROf[:, np.newaxis]
 
+    n_coef = hl_coef.shape[0]
+    if dual:
+        assert hr_coef.shape[0] == n_coef
+        hr = &hr_coef[0]
+        hrp = &hrp_coef[0]
+    hl = &hl_coef[0]
+    hlp = &hlp_coef[0]
+
+    rays_x = np.ascontiguousarray(rays[0])
+    rays_z = np.ascontiguousarray(rays[2])
+    ts_v = ts
+    t0s_v = t0s
+
+    if have_stats:
+        assert stats.shape[0] == STATS_LEN
+        stats_v = stats
+
     big_ys = 0
     big_ys_sum = 0
-
-    for i in range(n):
-        Rp_x = rays[0, i]
-        Rp_z = rays[2, i]
-
-        t0 = t0s[i]
-        if not dual:
-            t = find_t(hl_coef, hlp_coef, w, T, ROf_x, ROf_z, Rp_x, Rp_z, t0)
-        elif False:  # isfinite(t0) and Rp_x * t0 - ROf_x < T - 1:
-            tl = find_t(hl_coef, hlp_coef, w, T, ROf_x, ROf_z, Rp_x, Rp_z, t0)
-            if Rp_x * tl - ROf_x < T:
-                t = tl
+    bad_ts = 0
+
+    # buf, block and st are assigned in the parallel block, so each thread
+    # gets its own.
+    with nogil, parallel():
+        buf = <RootBuffers *> malloc(sizeof(RootBuffers))
+        block = alloc_buffers(buf, n_coef)
+        st = <SolveStats *> calloc(1, sizeof(SolveStats))
+
+        for i in prange(n, schedule='guided'):
+            Rp_x = rays_x[i]
+            Rp_z = rays_z[i]
+
+            if not dual:
+                t = find_t(hl, hlp, n_coef, w, T, ROf_x, ROf_z, Rp_x, Rp_z,
+                           t0s_v[i], buf, st)
             else:
-                tr = find_t(hr_coef, hrp_coef, w, T, ROf_x, ROf_z, Rp_x, Rp_z, t0)
-                t = max(tl, tr)
-        elif False:  # isfinite(t0) and Rp_x * t0 - ROf_x > T + 1:
-            tr = find_t(hr_coef, hrp_coef, w, T, ROf_x, ROf_z, Rp_x, Rp_z, t0)
-            if Rp_x * tr - ROf_x < T:
-                t = tr
-            else:
-                tl = find_t(hl_coef, hlp_coef, w, T, ROf_x, ROf_z, Rp_x, Rp_z, t0)
-                t = max(tl, tr)
-        else:
-            tl = find_t(hl_coef, hlp_coef, w, T, ROf_x, ROf_z, Rp_x, Rp_z, t0)
-            tr = find_t(hr_coef, hrp_coef, w, T, ROf_x, ROf_z, Rp_x, Rp_z, t0)
-            if tl < 0 and tr < 0:
-                xl = Rp_x * tl - ROf_x
-                xr = Rp_x * tr - ROf_x
-                if xl < T and xr > T:
-                    t = tl if fabs(tl + 1) < fabs(tr + 1) else tr
+                tl = find_t(hl, hlp, n_coef, w, T, ROf_x, ROf_z, Rp_x, Rp_z,
+                            t0s_v[i], buf, st)
+                tr = find_t(hr, hrp, n_coef, w, T, ROf_x, ROf_z, Rp_x, Rp_z,
+                            t0s_v[i], buf, st)
+                if tl < 0 and tr < 0:
+                    xl = Rp_x * tl - ROf_x
+                    xr = Rp_x * tr - ROf_x
+                    if xl < T and xr > T:
+                        t = tl if fabs(tl + 1) < fabs(tr + 1) else tr
+                    else:
+                        t = tl if xl < T else tr
                 else:
-                    t = tl if xl < T else tr
-                # if fabs(y) > 1e-4:
-                #     print '{:1.3f} {:4.0f}; {:1.3f} {:4.0f}'.format(tl, xl, tr, xr)
-            else:
-                t = min(tl, tr)
-
-        assert isfinite(t)
-        ts[i] = t
-        u = w * (Rp_x * t - ROf_x - T)
-        y = fabs(poly_eval(hl_coef, u) / w - fma(Rp_z, t, -ROf_z))
-        if dual:
-            yr = fabs(poly_eval(hr_coef, u) / w - fma(Rp_z, t, -ROf_z))
-            y = min(y, yr)
+                    t = min(tl, tr)
 
-        if fabs(y) > 1e-4:
-            # print 'big y 2!', y
-            big_ys += 1
-            big_ys_sum += y
+            if not isfinite(t):
+                bad_ts += 1
 
-        t0s[i] = ts[i]
-
-    # print 'final ts:', ts
-    if big_ys > 0:
+            ts_v[i] = t
+            u = w * (Rp_x * t - ROf_x - T)
+            y = fabs(poly_eval(hl, n_coef, u) / w - fma(Rp_z, t, -ROf_z))
+            if dual:
+                yr = fabs(poly_eval(hr, n_coef, u) / w - fma(Rp_z, t, -ROf_z))
+                y = min(y, yr)
+
+            if y > 1e-4:
+                big_ys += 1
+                big_ys_sum += y
+
+            t0s_v[i] = t
+
+        if have_stats:
+            with gil:
+                stats_v[STAT_SOLVES] += st.solves
+                stats_v[STAT_COLD] += st.cold
+                stats_v[STAT_FALLBACKS] += st.fallbacks
+                stats_v[STAT_ESCAPES] += st.escapes
+                for k in range(NEWTON_ITERS + 1):
+                    stats_v[STAT_ITERS + k] += st.iters[k]
+
+        free(st)
+        free(block)
+        free(buf)
+
+    assert bad_ts == 0
+    if have_stats:
+        stats[STAT_BIG_YS] += big_ys
+    elif big_ys > 0:
         print 'big ys:', big_ys, 'avg:', big_ys_sum / big_ys
 
     return ts, ts * rays - ROf[:, np.newaxis]
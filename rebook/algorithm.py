@@ -7,7 +7,7 @@ from scipy import interpolate
 
 import lib
 
-from geometry import Line
+from geometry import Crop, Line
 from lib import debug_imwrite, is_bw
 from letters import Letter, TextLine
 
@@ -31,6 +31,51 @@ def skew_angle(im, orig, AH, lines):
 
     return np.median(alphas)
 
+PROJECTION_WIDTH = 800
+MIN_PROJECTION_CONFIDENCE = 0.2
+def projection_profile_scores(ys, xs, weights, n_rows, angles):
+    scores = []
+    for angle in angles:
+        rows = ys * math.cos(angle) - xs * math.sin(angle)
+        rows = np.round(rows - rows.min()).astype(np.int64)
+        profile = np.bincount(rows, weights=weights, minlength=n_rows)
+        scores.append(np.dot(profile, profile))
+    return np.array(scores)
+
+# Skew from projection-profile variance on a downsampled page; no layout
+# analysis needed. Coarse search over [-max_angle, max_angle], then refine.
+# Returns (angle, confidence); confidence in [0, 1] is how far the best
+# profile stands out from the median angle.
+def projection_skew_angle(bw, max_angle=0.1, n_coarse=41, n_levels=3):
+    im_h, im_w = bw.shape[:2]
+    scale = min(1.0, PROJECTION_WIDTH / im_w)
+    ink = (bw < 128).astype(np.float32)
+    if scale < 1.0:
+        ink = cv2.resize(ink, (0, 0), None, scale, scale,
+                         interpolation=cv2.INTER_AREA)
+
+    ys, xs = np.nonzero(ink)
+    if ys.shape[0] == 0: return 0., 0.
+    weights = ink[ys, xs].astype(np.float64)
+    ys = ys.astype(np.float64)
+    xs = xs.astype(np.float64)
+    n_rows = int(math.ceil(np.hypot(*ink.shape))) + 1
+
+    angles = np.linspace(-max_angle, max_angle, n_coarse)
+    scores = projection_profile_scores(ys, xs, weights, n_rows, angles)
+    confidence = 1 - np.median(scores) / scores.max()
+
+    step = angles[1] - angles[0]
+    best = angles[scores.argmax()]
+    for _ in range(n_levels):
+        angles = np.linspace(best - step, best + step, 11)
+        scores = projection_profile_scores(ys, xs, weights, n_rows, angles)
+        best = angles[scores.argmax()]
+        step = angles[1] - angles[0]
+
+    if lib.debug: print('projection skew:', best, 'confidence:', confidence)
+    return best, confidence
+
 def lu_dewarp(im):
     # morphological operators
     morph_a = [
@@ -151,7 +196,7 @@ def combine_underlined(AH, im, lines, components):
             base_ys = base_points[:, 1]
             underline_ys = bottom[base_points[:, 0] - underline.x]
             if np.all(np.abs(base_ys - underline_ys) < AH):
-                line.underlines.append(underline)
+                line.add_underline(underline)
                 close_lines.append(line)
 
         if len(close_lines) > 1:
@@ -281,9 +326,23 @@ def dewarp_text(im):
 
     return AB, DC, bounds
 
+# padding and affine matrix safe_rotate uses for an image of this shape.
+def rotation_transform(shape, angle):
+    im_h, im_w = shape[:2]
+    angle_deg = angle * 180 / math.pi
+
+    im_h_new = im_w * abs(math.sin(angle)) + im_h * math.cos(angle)
+    im_w_new = im_h * abs(math.sin(angle)) + im_w * math.cos(angle)
+
+    pad_h = int(math.ceil((im_h_new - im_h) / 2))
+    pad_w = int(math.ceil((im_w_new - im_w) / 2))
+
+    padded_h, padded_w = im_h + 2 * pad_h, im_w + 2 * pad_w
+    matrix = cv2.getRotationMatrix2D((padded_w / 2, padded_h / 2), angle_deg, 1)
+    return (pad_h, pad_w), matrix
+
 def safe_rotate(im, angle):
     debug_imwrite('prerotated.png', im)
-    im_h, im_w = im.shape[:2]
     if abs(angle) > math.pi / 4:
         print("warning: too much rotation")
         return im
@@ -291,22 +350,69 @@ def safe_rotate(im, angle):
     angle_deg = angle * 180 / math.pi
     print('rotating to angle:', angle_deg, 'deg')
 
-    im_h_new = im_w * abs(math.sin(angle)) + im_h * math.cos(angle)
-    im_w_new = im_h * abs(math.sin(angle)) + im_w * math.cos(angle)
-
-    pad_h = int(math.ceil((im_h_new - im_h) / 2))
-    pad_w = int(math.ceil((im_w_new - im_w) / 2))
+    (pad_h, pad_w), matrix = rotation_transform(im.shape, angle)
     pads = ((pad_h, pad_h), (pad_w, pad_w)) + ((0, 0),) * (len(im.shape) - 2)
 
     padded = np.pad(im, pads, 'constant', constant_values=255)
     padded_h, padded_w = padded.shape[:2]
-    matrix = cv2.getRotationMatrix2D((padded_w / 2, padded_h / 2), angle_deg, 1)
     result = cv2.warpAffine(padded, matrix, (padded_w, padded_h),
                             borderMode=cv2.BORDER_CONSTANT,
                             borderValue=255)
     debug_imwrite('rotated.png', result)
     return result
 
+# safe_rotate(im, angle) followed by crop.apply, warping only the crop region.
+# crop is in safe_rotate's output coordinates.
+def rotate_crop(im, angle, crop):
+    if abs(angle) > math.pi / 4:
+        print("warning: too much rotation")
+        return crop.apply(im)
+
+    (pad_h, pad_w), matrix = rotation_transform(im.shape, angle)
+    im_h, im_w = im.shape[:2]
+    crop = crop.intersect(Crop(0, 0, im_w + 2 * pad_w, im_h + 2 * pad_h))
+    assert crop.nonempty()
+
+    # fold the padding and the crop origin into the affine matrix.
+    matrix[:, 2] += matrix[:, :2].dot((pad_w, pad_h)) - (crop.x0, crop.y0)
+    result = cv2.warpAffine(im, matrix, (int(crop.w), int(crop.h)),
+                            borderMode=cv2.BORDER_CONSTANT,
+                            borderValue=(255, 255, 255))
+    debug_imwrite('rotated.png', result)
+    return result
+
+# map (N, 2) points of an image with this shape into safe_rotate's output.
+def rotate_points(points, shape, angle):
+    points = np.asarray(points, dtype=np.float64)
+    if abs(angle) > math.pi / 4:
+        return points
+
+    (pad_h, pad_w), matrix = rotation_transform(shape, angle)
+    padded = points + (pad_w, pad_h)
+    return padded.dot(matrix[:, :2].T) + matrix[:, 2]
+
+# Deskew without a second layout pass: beyond this angle, re-run crop().
+MAX_TRANSFORM_SKEW = 0.1
+
+# bounding box in safe_rotate's output of the lines' letter and underline
+# boxes. offset: origin of the rotated image in the lines' coordinates.
+def rotated_lines_crop(lines, offset, shape, angle):
+    boxes = [line.table() for line in lines]
+    boxes += [np.array([u.stats[:4] for u in line.underlines]).reshape(-1, 4)
+              for line in lines]
+    x, y, w, h = np.concatenate(boxes).T
+    corners = np.concatenate([
+        np.stack([x, y], axis=1),
+        np.stack([x + w, y], axis=1),
+        np.stack([x, y + h], axis=1),
+        np.stack([x + w, y + h], axis=1),
+    ]) - np.asarray(offset)
+
+    rotated = rotate_points(corners, shape, angle)
+    x0, y0 = np.floor(rotated.min(axis=0)).astype(int)
+    x1, y1 = np.ceil(rotated.max(axis=0)).astype(int)
+    return Crop(x0, y0, x1, y1)
+
 def fast_stroke_width(im):
     # im should be black-on-white. max stroke width 41.
     assert im.dtype == np.uint8 and is_bw(im)
@@ -327,16 +433,22 @@ def fast_stroke_width(im):
 
     return dists
 
-# only after rotation!
+# fine_dewarp: baseline offsets are clipped to FINE_DEWARP_MAX pixels and
+# evaluated every FINE_DEWARP_STEP pixels, then interpolated bilinearly into
+# remap maps FINE_DEWARP_TILE rows at a time.
+FINE_DEWARP_MAX = 3
+FINE_DEWARP_STEP = 16
+FINE_DEWARP_TILE = 256
+# Straighten nearly horizontal lines of a deskewed page by shifting each
+# column of pixels vertically along a smooth field fit to the letters' base
+# points. only after rotation! Returns im if too few lines are usable.
 def fine_dewarp(im, lines):
     im_h, im_w = im.shape[:2]
 
-    debug = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)
     points = []
     y_offsets = []
     for line in lines:
         if len(line) < 10 or abs(line.fit_line().angle()) > 0.001: continue
-        line.fit_line().draw(debug, thickness=1)
         base_points = np.array([letter.base_point() for letter in line.inliers()])
         median_y = np.median(base_points[:, 1])
         y_offsets.append(median_y - base_points[:, 1])
@@ -348,41 +460,64 @@ def fine_dewarp(im, lines):
                 underline.x + np.arange(underline.w), mid_contour,
             ])
             mid_points = all_mid_points[:, ::4]
-            points.append(mid_points)
+            y_offsets.append(np.median(mid_points[1]) - mid_points[1])
+            points.append(mid_points.T)
 
-        for p in base_points:
-            pt = tuple(np.round(p).astype(int))
-            cv2.circle(debug, (pt[0], int(median_y)), 2, lib.RED, -1)
-            cv2.circle(debug, pt, 2, lib.GREEN, -1)
-    cv2.imwrite('points.png', debug)
+    # SmoothBivariateSpline needs (3 + 1) ** 2 points.
+    if sum(len(offsets) for offsets in y_offsets) < 16:
+        return im
 
     points = np.concatenate(points)
     y_offsets = np.concatenate(y_offsets)
-    mesh = np.mgrid[:im_w, :im_h].astype(np.float32)
-    xmesh, ymesh = mesh
 
-    # y_offset_interp = interpolate.griddata(points, y_offsets, xmesh, ymesh, method='nearest')
-    # y_offset_interp = y_offset_interp.clip(-5, 5)
-    # mesh[1] += y_offset_interp  # (mesh[0], mesh[1], grid=False)
+    if lib.debug:
+        debug = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)
+        for p, y_offset in zip(points, y_offsets):
+            pt = tuple(np.round(p).astype(int))
+            cv2.circle(debug, (pt[0], int(round(p[1] + y_offset))), 2, lib.RED, -1)
+            cv2.circle(debug, pt, 2, lib.GREEN, -1)
+        debug_imwrite('points.png', debug)
 
     y_offset_interp = interpolate.SmoothBivariateSpline(
-        points[:, 0], points[:, 1], y_offsets.clip(-3, 3),
+        points[:, 0], points[:, 1], y_offsets.clip(-FINE_DEWARP_MAX, FINE_DEWARP_MAX),
         s=4 * points.shape[0]
     )
-    ymesh -= y_offset_interp(xmesh, ymesh, grid=False).clip(-3, 3)
 
-    conv_xmesh, conv_ymesh = cv2.convertMaps(xmesh, ymesh, cv2.CV_16SC2)
-    out = cv2.remap(im, conv_xmesh, conv_ymesh,
-                    interpolation=cv2.INTER_LINEAR,
-                    borderValue=np.median(im)).T
-    cv2.imwrite('corrected.png', out)
+    # offsets on a grid covering the page; coarse[i, j] is at (j, i) * step.
+    step = FINE_DEWARP_STEP
+    grid_xs = np.arange(0, im_w - 1 + step, step, dtype=np.float64)
+    grid_ys = np.arange(0, im_h - 1 + step, step, dtype=np.float64)
+    coarse = y_offset_interp(grid_xs, grid_ys).T.clip(-FINE_DEWARP_MAX, FINE_DEWARP_MAX)
+    coarse = coarse.astype(np.float32)
+
+    xs = np.arange(im_w, dtype=np.float32)
+    x_index = np.minimum(np.arange(im_w) // step, len(grid_xs) - 2)
+    x_frac = ((xs - x_index * step) / step).astype(np.float32)
+    xmap = np.tile(xs, (min(FINE_DEWARP_TILE, im_h), 1))
+
+    out = np.empty_like(im)
+    border = float(np.median(im))
+    for y0 in range(0, im_h, FINE_DEWARP_TILE):
+        y1 = min(y0 + FINE_DEWARP_TILE, im_h)
+        ys = np.arange(y0, y1, dtype=np.float32)
+        y_index = np.minimum(np.arange(y0, y1) // step, len(grid_ys) - 2)
+        y_frac = ((ys - y_index * step) / step).astype(np.float32)[:, np.newaxis]
+        rows = coarse[y_index] * (1 - y_frac) + coarse[y_index + 1] * y_frac
+        offsets = rows[:, x_index] * (1 - x_frac) + rows[:, x_index + 1] * x_frac
+
+        ymap = ys[:, np.newaxis] - offsets
+        out[y0:y1] = cv2.remap(im, xmap[:y1 - y0], ymap,
+                               interpolation=cv2.INTER_LINEAR, borderValue=border)
 
-    debug = cv2.cvtColor(out, cv2.COLOR_GRAY2BGR)
-    for line in lines:
-        base_points = np.array([letter.base_point() for letter in line.inliers()[1:-1]])
-        base_points[:, 1] -= y_offset_interp(base_points[:, 0], base_points[:, 1], grid=False)
-        Line.fit(base_points).draw(debug, thickness=1)
-    cv2.imwrite('corrected_line.png', debug)
+    if lib.debug:
+        debug_imwrite('corrected.png', out)
+        debug = cv2.cvtColor(out, cv2.COLOR_GRAY2BGR)
+        for line in lines:
+            base_points = np.array([letter.base_point() for letter in line.inliers()[1:-1]])
+            if len(base_points) < 2: continue
+            base_points[:, 1] -= y_offset_interp(base_points[:, 0], base_points[:, 1], grid=False)
+            Line.fit(base_points).draw(debug, thickness=1)
+        debug_imwrite('corrected_line.png', debug)
 
     return out
 
@@ -395,49 +530,57 @@ def masked_mean_std(data, mask):
     std = np.sqrt(np.square(data_dev).sum() / mask_sum)
     return mean, std
 
+def label_moments(data, label_map):
+    # per-label pixel count, sum and sum of squares of data, via the label map.
+    labels = label_map.ravel()
+    values = data.ravel().astype(np.float64)
+    counts = np.bincount(labels)
+    sums = np.bincount(labels, weights=values)
+    sq_sums = np.bincount(labels, weights=values * values)
+    return counts, sums, sq_sums
+
 def remove_stroke_outliers(im, lines, k=1.0):
     stroke_widths = fast_stroke_width(im)
     if lib.debug:
         lib.debug_imwrite('strokes.png', lib.normalize_u8(stroke_widths.clip(0, 10)))
 
-    mask = np.zeros(im.shape, dtype=np.uint8)
-    for line in lines:
-        for letter in line:
-            sliced = letter.crop().apply(mask)
-            sliced |= letter.raster()
+    all_line_letters = [letter for line in lines for letter in line]
+    if not all_line_letters: return []
 
-    lib.debug_imwrite('letter_mask.png', -mask)
+    label_map = all_line_letters[0].label_map
+    counts, sums, sq_sums = label_moments(stroke_widths, label_map)
 
-    masked_strokes = stroke_widths.copy()
-    masked_strokes &= -mask
+    labels = np.unique([letter.label for letter in all_line_letters])
+    if lib.debug:
+        mask = lib.bool_to_u8(np.isin(label_map, labels))
+        lib.debug_imwrite('letter_mask.png', mask)
 
-    strokes_mean, strokes_std = masked_mean_std(masked_strokes, mask)
+    mask_sum = counts[labels].sum()
+    strokes_mean = sums[labels].sum() / mask_sum
+    strokes_std = np.sqrt(max(sq_sums[labels].sum() / mask_sum - strokes_mean ** 2, 0))
     if lib.debug:
         print('overall: mean:', strokes_mean, 'std:', strokes_std)
 
-    debug = cv2.cvtColor(im, cv2.COLOR_GRAY2RGB)
+    safe_counts = np.maximum(counts, 1)
+    means = sums / safe_counts
+    stds = np.sqrt((sq_sums / safe_counts - means ** 2).clip(0, None))
+    good_labels = (means >= strokes_mean - k * strokes_std) & (counts > 0)
+
+    debug = cv2.cvtColor(im, cv2.COLOR_GRAY2RGB) if lib.debug else None
     new_lines = []
     for line in lines:
         if len(line) <= 1: continue
-        good_letters = []
-        for letter in line:
-            crop = letter.crop()
-            if not crop.nonempty(): continue
-
-            raster = letter.raster()
-            sliced_strokes = crop.apply(stroke_widths).copy()
-            sliced_strokes &= lib.bool_to_u8(raster)
-
-            mean, std = masked_mean_std(sliced_strokes, raster)
-            if mean < strokes_mean - k * strokes_std:
-                if lib.debug:
+        line_labels = np.array([letter.label for letter in line])
+        good = good_labels[line_labels]
+        good_letters = [letter for letter, g in zip(line, good) if g]
+
+        if lib.debug:
+            for letter, g in zip(line, good):
+                if not g:
                     print('skipping {:4d} {:4d} {:.03f} {:.03f}'.format(
-                        letter.x, letter.y, mean, std,
+                        letter.x, letter.y, means[letter.label], stds[letter.label],
                     ))
-                    letter.box(debug, color=lib.RED)
-            else:
-                if lib.debug: letter.box(debug, color=lib.GREEN)
-                good_letters.append(letter)
+                letter.box(debug, color=lib.GREEN if g else lib.RED)
 
         if good_letters:
             new_lines.append(TextLine(good_letters, underlines=line.underlines))
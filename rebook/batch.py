@@ -3,12 +3,14 @@ from __future__ import print_function
 import argparse
 import cv2
 import glob
+import json
 import numpy as np
 import os
 import re
 import sys
+import time
 from fpdf import FPDF
-from multiprocessing import cpu_count
+from multiprocessing import cpu_count, Manager
 from multiprocessing.pool import Pool
 from os.path import join, isfile
 from subprocess import check_call, check_output
@@ -22,7 +24,92 @@ from lib import debug_imwrite
 import lib
 
 extension = '.png'
-def process_image(original, dpi=None):
+def estimate_skew(bw_cropped, original, AH, lines):
+    if args.skew == 'projection':
+        angle, confidence = algorithm.projection_skew_angle(bw_cropped)
+        if confidence >= algorithm.MIN_PROJECTION_CONFIDENCE:
+            return angle
+        print('projection skew confidence {:.2f}; falling back to lines'.format(confidence))
+
+    return algorithm.skew_angle(bw_cropped, original, AH, lines)
+
+def dewarp_pages(original_rot90, dpi, source_dpi, book=None, page_index=None,
+                 models=None, stats=None):
+    # output is gray or bilevel; render one channel at the output DPI.
+    spec = dewarp.RenderSpec(scale=float(dpi) / source_dpi if source_dpi else None,
+                             gray=True, grid_step=args.grid_step)
+    dewarped_images = dewarp.kim2014(original_rot90,
+                                     processes=args.restart_processes,
+                                     book=book, page_index=page_index,
+                                     rig=rig, spec=spec, models=models,
+                                     solver=args.solver,
+                                     time_budget=args.page_budget,
+                                     max_nfev=args.max_nfev,
+                                     stats=stats, surface=args.surface,
+                                     fit_scale=args.fit_scale)
+    cropped_images = []
+    for im in dewarped_images:
+        bw = binarize.binarize(im, algorithm=binarize.sauvola, resize=1.0)
+        lib.debug_prefix.append('crop')
+        _, [lines] = crop(im, bw, split=False)
+        lib.debug_prefix.pop()
+        c = Crop.from_lines(lines)
+        if c.nonempty():
+            cropped_images.append(Crop.from_whitespace(bw).apply(im))
+
+    return cropped_images
+
+def deskew_pages(original_rot90, split):
+    bw = binarize.binarize(original_rot90, algorithm=binarize.adaptive_otsu, resize=1.0)
+    debug_imwrite('thresholded.png', bw)
+    AH, line_sets = crop(original_rot90, bw, split=split)
+
+    cropped_images = []
+    for lines in line_sets:
+        c = Crop.from_lines(lines)
+        if c.nonempty():
+            lib.debug = False
+            bw_cropped = c.apply(bw)
+            orig_cropped = c.apply(original_rot90)
+            angle = estimate_skew(bw_cropped, original_rot90, AH, lines)
+            if not np.isfinite(angle): angle = 0.
+
+            dewarped = None
+
+            if args.fast_deskew and abs(angle) <= algorithm.MAX_TRANSFORM_SKEW:
+                # carry the existing layout through the rotation.
+                new_crop = algorithm.rotated_lines_crop(
+                    lines, (c.x0, c.y0), orig_cropped.shape, angle
+                )
+            else:
+                # layout only needs one channel; rotate the gray page.
+                rotated = algorithm.safe_rotate(binarize.grayscale(orig_cropped), angle)
+                rotated_bw = binarize.binarize(rotated, algorithm=binarize.adaptive_otsu)
+                _, [new_lines] = crop(rotated, rotated_bw, split=False)
+                new_crop = Crop.union_all([line.crop() for line in new_lines])
+                if args.fine_dewarp:
+                    # shifts are a few pixels, so new_crop still holds.
+                    dewarped = algorithm.fine_dewarp(rotated, new_lines)
+
+            if new_crop.nonempty():
+                if dewarped is not None:
+                    cropped = new_crop.apply(dewarped)
+                else:
+                    cropped = algorithm.rotate_crop(orig_cropped, angle, new_crop)
+                cropped_images.append(cropped)
+
+    return cropped_images
+
+# models: list receiving each dewarped page's DewarpModel. metrics: dict
+# receiving how the page was processed ('method': dewarp, deskew or
+# fallback, with 'fallback_reason'), 'seconds' and, when dewarping, the
+# solver telemetry of each page of the image ('dewarp').
+def process_image(original, dpi=None, book=None, page_index=None, models=None,
+                  metrics=None):
+    if metrics is None:
+        metrics = {}
+    start = time.time()
+
     original_rot90 = original
 
     for i in range(args.rotate // 90):
@@ -31,51 +118,34 @@ def process_image(original, dpi=None):
     # original_rot90 = cv2.resize(original_rot90, (0, 0), None, 1.5, 1.5)
     im_h, im_w = original_rot90.shape[:2]
     # image height should be about 10 inches. round to 100
+    source_dpi = int(round(im_h / 1100.0) * 100)
     if not dpi:
-        dpi = int(round(im_h / 1100.0) * 100)
+        dpi = source_dpi
         print('detected dpi:', dpi)
 
     split = im_w > im_h # two pages
 
-    cropped_images = []
+    cropped_images = None
     if args.dewarp:
         lib.debug_prefix.append('dewarp')
-        dewarped_images = dewarp.kim2014(original_rot90)
-        for im in dewarped_images:
-            bw = binarize.binarize(im, algorithm=binarize.sauvola, resize=1.0)
-            lib.debug_prefix.append('crop')
-            _, [lines] = crop(im, bw, split=False)
+        metrics['dewarp'] = []
+        try:
+            cropped_images = dewarp_pages(original_rot90, dpi, source_dpi, book=book,
+                                          page_index=page_index, models=models,
+                                          stats=metrics['dewarp'])
+            metrics['method'] = 'dewarp'
+        except dewarp.DewarpFailed as e:
+            print('dewarp failed ({}); deskewing instead.'.format(e))
+            metrics['method'] = 'fallback'
+            metrics['fallback_reason'] = str(e)
+            if models is not None:
+                del models[:]
+        finally:
             lib.debug_prefix.pop()
-            c = Crop.from_lines(lines)
-            if c.nonempty():
-                cropped_images.append(Crop.from_whitespace(bw).apply(im))
-        lib.debug_prefix.pop()
-    else:
-        bw = binarize.binarize(original_rot90, algorithm=binarize.adaptive_otsu, resize=1.0)
-        debug_imwrite('thresholded.png', bw)
-        AH, line_sets = crop(original_rot90, bw, split=split)
-
-        for lines in line_sets:
-            c = Crop.from_lines(lines)
-            if c.nonempty():
-                lib.debug = False
-                bw_cropped = c.apply(bw)
-                orig_cropped = c.apply(original_rot90)
-                angle = algorithm.skew_angle(bw_cropped, original_rot90, AH, lines)
-                if not np.isfinite(angle): angle = 0.
-                rotated = algorithm.safe_rotate(orig_cropped, angle)
-
-                rotated_bw = binarize.binarize(rotated, algorithm=binarize.adaptive_otsu)
-                _, [new_lines] = crop(rotated, rotated_bw, split=False)
-
-                # dewarped = algorithm.fine_dewarp(rotated, new_lines)
-                # _, [new_lines] = crop(rotated, rotated_bw, split=False)
-                new_crop = Crop.union_all([line.crop() for line in new_lines])
 
-                if new_crop.nonempty():
-                    # cropped = new_crop.apply(dewarped)
-                    cropped = new_crop.apply(rotated)
-                    cropped_images.append(cropped)
+    if cropped_images is None:
+        cropped_images = deskew_pages(original_rot90, split)
+        metrics.setdefault('method', 'deskew')
 
     out_images = []
     lib.debug_prefix.append('binarize')
@@ -90,26 +160,68 @@ def process_image(original, dpi=None):
         lib.debug_prefix.pop()
     lib.debug_prefix.pop()
 
+    metrics['seconds'] = time.time() - start
     return dpi, out_images
 
+# Returns output paths and the page's metrics (see process_image).
 def process_file(file_args):
-    (inpath, outdir, dpi) = file_args
+    (inpath, outdir, dpi, page_index, book) = file_args
     outfiles = glob.glob('{}/{}_*{}'.format(outdir, inpath[:-4], extension))
     if outfiles:
         print('skipping', inpath)
-        return outfiles
+        return outfiles, {'method': 'skipped'}
     else:
         print('processing', inpath)
 
     original = lib.imread(inpath)
-    dpi, out_images = process_image(original, dpi=dpi)
+    models = [] if args.save_models else None
+    metrics = {}
+    dpi, out_images = process_image(original, dpi=dpi, book=book,
+                                    page_index=page_index, models=models,
+                                    metrics=metrics)
+    for idx, model in enumerate(models or []):
+        modelfile = '{}/{}_model{}.json'.format(outdir, inpath[:-4], idx)
+        print('    writing', modelfile)
+        model.save(modelfile)
+
     for idx, outimg in enumerate(out_images):
         outfile = '{}/{}_{}{}'.format(outdir, inpath[:-4], idx, extension)
         print('    writing', outfile)
         cv2.imwrite(outfile, outimg)
         outfiles.append(outfile)
 
-    return outfiles
+    return outfiles, metrics
+
+# Run-level view of per-page metrics: pages per method, page latency and
+# aggregated dewarp solver telemetry.
+def summarize_metrics(page_metrics):
+    methods = [m['method'] for m in page_metrics]
+    seconds = [m['seconds'] for m in page_metrics if 'seconds' in m]
+    summary = {
+        'pages': len(page_metrics),
+        'methods': {method: methods.count(method) for method in set(methods)},
+    }
+    processed = len(seconds)
+    if processed > 0:
+        summary['fallback_rate'] = methods.count('fallback') / float(processed)
+        summary['seconds_median'] = float(np.median(seconds))
+        summary['seconds_max'] = max(seconds)
+
+    summary['dewarp'] = dewarp.merge_solver_stats(
+        sum([m.get('dewarp', []) for m in page_metrics], [])
+    )
+    return summary
+
+def write_metrics(path, files, page_metrics):
+    summary = summarize_metrics(page_metrics)
+    print('page methods:', summary['methods'])
+    if summary['dewarp']['pages'] > 0:
+        print('dewarp: {nfev} evaluations, {restarts} runs; newton fallback rate '
+              '{rate:.3f}'.format(rate=summary['dewarp']['newton']['fallback_rate'],
+                                  **summary['dewarp']))
+    with open(path, 'w') as metrics_file:
+        json.dump({'summary': summary, 'pages': dict(zip(files, page_metrics))},
+                  metrics_file, indent=2, sort_keys=True)
 
 def pdfimages(pdf_filename):
     assert pdf_filename.endswith('.pdf')
@@ -148,6 +260,12 @@ def accumulate_paths(target, accum):
             accumulate_paths(files, accum)
 
 def run(args):
+    global rig
+    rig = None
+    if args.rig:
+        # kim2014 takes the focal length from the rig.
+        rig = dewarp.RigProfile.load(args.rig)
+
     if args.single_file:
         lib.debug = True
         im = lib.imread(args.single_file)
@@ -159,8 +277,11 @@ def run(args):
     if args.concurrent:
         pool = Pool(cpu_count())
         map_fn = pool.map
+        # workers see each other's finished pages.
+        book = dewarp.BookParams(Manager().dict())
     else:
         map_fn = map
+        book = dewarp.BookParams()
 
     files = []
     accumulate_paths(args.indirs, files)
@@ -172,11 +293,16 @@ def run(args):
         if not os.path.isdir(join(args.outdir, d)):
             os.makedirs(join(args.outdir, d))
 
-    outfiles = map_fn(process_file, list(zip(files,
-                        [args.outdir] * len(files),
-                        [args.dpi] * len(files))))
+    results = list(map_fn(process_file, list(zip(files,
+                          [args.outdir] * len(files),
+                          [args.dpi] * len(files),
+                          range(len(files)),
+                          [book] * len(files)))))
 
-    outfiles = sum(outfiles, [])
+    write_metrics(join(args.outdir, 'metrics.json'), files,
+                  [metrics for _, metrics in results])
+
+    outfiles = sum([page_outfiles for page_outfiles, _ in results], [])
     outfiles.sort(key=lambda f: list(map(int, re.findall('[0-9]+', f))))
 
     # outtif = join(args.outdir, 'out.tif')
@@ -199,6 +325,12 @@ def run(args):
 
         pdf.output(name=outpdfpath)
 
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError('must be at least 1: {}'.format(value))
+    return n
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Batch-process for PDF')
     parser.add_argument('outdir', nargs='?', help="Output directory")
@@ -210,6 +342,34 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--dpi', action='store', type=int,
                         help="Force a particular DPI")
     parser.add_argument('--dewarp', action='store_true', help="Dewarp pages.")
+    parser.add_argument('--fast-deskew', action='store_true',
+                        help="Rotate layout geometry instead of re-analyzing deskewed pages.")
+    parser.add_argument('--skew', action='store', choices=['lines', 'projection'],
+                        default='lines', help="Skew estimator for deskewing.")
+    parser.add_argument('--no-fine-dewarp', action='store_false', dest='fine_dewarp',
+                        help="Don't straighten baselines of deskewed pages.")
+    parser.add_argument('--restart-processes', action='store', type=int, default=1,
+                        help="Run dewarp optimizer restarts in this many threads.")
+    parser.add_argument('--solver', action='store', choices=['trf', 'lm'],
+                        default=dewarp.SOLVER, help="Dewarp optimizer.")
+    parser.add_argument('--page-budget', action='store', type=float,
+                        help="Seconds to dewarp a page; pages that run over or don't "
+                        "converge are deskewed instead.")
+    parser.add_argument('--max-nfev', action='store', type=positive_int,
+                        help="Residual evaluations per dewarp optimizer run; pages "
+                        "that don't converge within it are deskewed instead.")
+    parser.add_argument('--surface', action='store', choices=['poly', 'spline'],
+                        default=dewarp.SURFACE, help="Dewarp page-surface model.")
+    parser.add_argument('--fit-scale', action='store', type=float, default=1.0,
+                        help="Fit the dewarp model on pages resized by this "
+                        "(e.g. 0.5); output is still rendered from the original.")
+    parser.add_argument('--grid-step', action='store', type=positive_int,
+                        help="Interpolate dewarp remaps from a control grid this "
+                        "many output pixels apart (e.g. 16).")
+    parser.add_argument('--rig', action='store',
+                        help="Rig profile from rig.py; locks camera pose when dewarping.")
+    parser.add_argument('--save-models', action='store_true',
+                        help="Save each dewarped page's model for render.py.")
     parser.add_argument('--rotate', action='store', type=int, choices=[0, 90, 180, 270],
                         default=0, help="Rotate CCW by 90, 180, or 270 degrees.")
 
@@ -2,16 +2,21 @@ from __future__ import print_function
 
 import cv2
 import itertools
+import json
 import numpy as np
 import sys
+import threading
+import time
 
 from math import atan2, pi
+from multiprocessing.pool import ThreadPool
 from numpy import dot, newaxis
-from numpy.linalg import norm, inv, solve
+from numpy.linalg import norm, inv, solve, LinAlgError
 from numpy.polynomial import Polynomial as Poly
 from scipy import optimize as opt
 from scipy import interpolate
-from scipy.linalg import block_diag
+from scipy import sparse
+from scipy.linalg import block_diag, cho_factor, cho_solve
 from skimage.measure import ransac
 
 import algorithm
@@ -23,7 +28,8 @@ import lib
 from lib import RED, GREEN, BLUE, draw_circle, draw_line
 import newton
 
-# focal length f = 3270.5 pixels
+# Default focal length f = 3270.5 pixels. Never reassigned: other cameras
+# pass focal_length (e.g. from a RigProfile) down to each Kim2014.
 f = 3270.5
 Of = np.array([0, 0, f], dtype=np.float64)
 
@@ -50,28 +56,33 @@ class LinearXModel(object):
     def residuals(self, data):
         return abs(self.params(data[:, 1]) - data[:, 0])
 
-def side_lines(AH, lines):
-    im_h, _ = bw.shape
-
+# bw: page image for debug output.
+def side_lines(AH, lines, bw=None):
     left_bounds = np.array([l.original_letters[0].left_mid() for l in lines])
     right_bounds = np.array([l.original_letters[-1].right_mid() for l in lines])
 
     vertical_lines = []
-    debug = cv2.cvtColor(bw, cv2.COLOR_GRAY2BGR)
+    side_inliers = []
     for coords in [left_bounds, right_bounds]:
         model, inliers = ransac(coords, LinearXModel, 3, AH / 10.0)
         vertical_lines.append(model.params)
-        for p, inlier in zip(coords, inliers):
-            draw_circle(debug, p, 4, color=GREEN if inlier else RED)
+        side_inliers.append(inliers)
+
+    if lib.debug and bw is not None:
+        im_h, _ = bw.shape
+        debug = cv2.cvtColor(bw, cv2.COLOR_GRAY2BGR)
+        for coords, inliers in zip([left_bounds, right_bounds], side_inliers):
+            for p, inlier in zip(coords, inliers):
+                draw_circle(debug, p, 4, color=GREEN if inlier else RED)
 
-    for p in vertical_lines:
-        draw_line(debug, (p(0), 0), (p(im_h), im_h), BLUE, 2)
-    lib.debug_imwrite('vertical.png', debug)
+        for p in vertical_lines:
+            draw_line(debug, (p(0), 0), (p(im_h), im_h), BLUE, 2)
+        lib.debug_imwrite('vertical.png', debug)
 
     return vertical_lines
 
-def estimate_vanishing(AH, lines):
-    p_left, p_right = side_lines(AH, lines)
+def estimate_vanishing(AH, lines, bw=None):
+    p_left, p_right = side_lines(AH, lines, bw=bw)
     vy, = (p_left - p_right).roots()
     return np.array((p_left(vy), vy))
 
@@ -104,7 +115,7 @@ def merge_lines(AH, lines):
         if (overlap > .8 * line.width() or overlap > .8 * last.width()) \
                 and abs(integ(x_max) - integ(x_min)) / overlap < AH / 8.0:
             out_lines[-1].merge(line)
-            points = np.array([letter.base_point() for letter in out_lines[-1]])
+            points = out_lines[-1].base_points()
             new_model, inliers = ransac(points, PolyModel5, 10, AH / 15.0)
             out_lines[-1].compress(inliers)
             out_lines[-1].model = new_model.params
@@ -127,7 +138,7 @@ def remove_outliers(im, AH, lines):
     for l in lines:
         if len(l) < 5: continue
 
-        points = np.array([letter.base_point() for letter in l])
+        points = l.base_points()
         min_samples = points.shape[0]//2+1
         model, inliers = ransac(data=points, model_class=PolyModel5, min_samples=min_samples, residual_threshold=AH / 10.0)
         poly = model.params
@@ -148,13 +159,76 @@ def remove_outliers(im, AH, lines):
     return merge_lines(AH, result)
 
 # @lib.timeit
-def correct_geometry(orig, mesh, interpolation=cv2.INTER_LINEAR):
-    # coordinates (u, v) on mesh -> mesh[u][v] = (x, y) in distorted image
-    mesh32 = mesh.astype(np.float32)
-    xmesh, ymesh = mesh32[:, :, 0], mesh32[:, :, 1]
-    conv_xmesh, conv_ymesh = cv2.convertMaps(xmesh, ymesh, cv2.CV_16SC2)
-    out = cv2.remap(orig, conv_xmesh, conv_ymesh, interpolation=interpolation,
-                    borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+def mesh_sample(mesh, row_indices, col_indices):
+    if isinstance(mesh, np.ndarray):
+        return mesh[np.ix_(row_indices, col_indices)]
+    else:
+        return mesh.sample(row_indices, col_indices)
+
+# every step-th index of range(n), plus the last.
+def grid_indices(n, step):
+    return np.unique(np.append(np.arange(0, n, step), n - 1))
+
+# Control grid sampled from a mesh every step output pixels (plus the last
+# row and column). The warp is smooth, so dense maps are interpolated from
+# the grid per band by tensor-product splines of degree grid_order (1:
+# bilinear, 3: bicubic) instead of evaluating every pixel. max_error:
+# largest distance in image pixels between interpolated and exact maps,
+# measured at cell and edge midpoints.
+class CoarseMesh(object):
+    def __init__(self, mesh, step, grid_order=1):
+        self.shape = mesh.shape[:2]
+        h, w = self.shape
+
+        row_indices, col_indices = grid_indices(h, step), grid_indices(w, step)
+        grid = mesh_sample(mesh, row_indices, col_indices)
+        self.splines = [
+            interpolate.RectBivariateSpline(row_indices, col_indices, grid[:, :, i],
+                                            kx=grid_order, ky=grid_order)
+            for i in range(2)
+        ]
+
+        mid_rows = (row_indices[:-1] + row_indices[1:]) // 2
+        mid_cols = (col_indices[:-1] + col_indices[1:]) // 2
+        check_rows = np.union1d(row_indices, mid_rows)
+        check_cols = np.union1d(col_indices, mid_cols)
+        exact = mesh_sample(mesh, check_rows, check_cols)
+        interpolated = np.stack([spline(check_rows, check_cols) for spline in self.splines],
+                                axis=2)
+        self.max_error = norm(interpolated - exact, axis=2).max()
+
+    def band(self, y0, y1):
+        rows, cols = np.arange(y0, y1), np.arange(self.shape[1])
+        return [spline(rows, cols).astype(np.float32) for spline in self.splines]
+
+MESH_BAND_ROWS = 256
+# mesh: SeparableMesh, CoarseMesh, or H x W x 2 array with mesh[u][v] = (x, y)
+# in the distorted image for output coordinates (u, v). Remapped band by
+# band, so full-size maps never exist. With grid_step (e.g. 16), maps are
+# interpolated from a CoarseMesh control grid of that spacing; worthwhile
+# when the mesh is expensive to evaluate per pixel (a SeparableMesh is not).
+def correct_geometry(orig, mesh, interpolation=cv2.INTER_LINEAR,
+                     band_rows=MESH_BAND_ROWS, grid_step=None, grid_order=1):
+    if grid_step is not None:
+        mesh = CoarseMesh(mesh, grid_step, grid_order=grid_order)
+        print('mesh grid max error: {:.3f} px'.format(mesh.max_error))
+
+    out_h, out_w = mesh.shape[:2]
+    out = np.empty((out_h, out_w) + orig.shape[2:], dtype=orig.dtype)
+    for y0 in range(0, out_h, band_rows):
+        y1 = min(y0 + band_rows, out_h)
+        if isinstance(mesh, np.ndarray):
+            band = mesh[y0:y1].astype(np.float32)
+            xmesh, ymesh = band[:, :, 0], band[:, :, 1]
+        else:
+            xmesh, ymesh = mesh.band(y0, y1)
+
+        conv_xmesh, conv_ymesh = cv2.convertMaps(xmesh, ymesh, cv2.CV_16SC2)
+        out[y0:y1] = cv2.remap(orig, conv_xmesh, conv_ymesh,
+                               interpolation=interpolation,
+                               borderMode=cv2.BORDER_CONSTANT,
+                               borderValue=(255, 255, 255))
+
     lib.debug_imwrite('corrected.png', out)
 
     return out
@@ -208,43 +282,46 @@ def R_theta(theta):
     ])
 
 FOCAL_PLANE_Z = -f
-def image_to_focal_plane(points, O):
+# focal_length defaults to the global f.
+def image_to_focal_plane(points, O, focal_length=None):
     if type(points) != np.ndarray:
         points = np.array(points)
 
     assert points.shape[0] == 2
+    focal_plane_z = FOCAL_PLANE_Z if focal_length is None else -focal_length
     return np.concatenate((
         points - O[:, newaxis],
-        np.full(points.shape[1:], FOCAL_PLANE_Z)[newaxis, ...]
+        np.full(points.shape[1:], focal_plane_z)[newaxis, ...]
     )).astype(np.float64)
 
-# points: 3 x ... array of points
-def project_to_image(points, O):
+# points: 3 x ... array of points; focal_length defaults to the global f.
+def project_to_image(points, O, focal_length=None):
     assert points.shape[0] == 3
-    projected = (points * FOCAL_PLANE_Z / points[2])[0:2]
+    focal_plane_z = FOCAL_PLANE_Z if focal_length is None else -focal_length
+    projected = (points * focal_plane_z / points[2])[0:2]
     return (projected.T + O).T
 
 # points: 3 x ... array of points
-def gcs_to_image(points, O, R):
+def gcs_to_image(points, O, R, focal_length=None):
     # invert R(pt - Of)
     assert points.shape[0] == 3
     image_coords = np.tensordot(inv(R), points, axes=1)
     image_coords_T = image_coords.T
-    image_coords_T += Of
-    return project_to_image(image_coords, O)
+    image_coords_T[:, 2] += f if focal_length is None else focal_length
+    return project_to_image(image_coords, O, focal_length)
 
 # O: two-dimensional origin (middle of image/principal point)
 # returns points on focal plane
-def line_base_points_modeled(line, O):
+def line_base_points_modeled(line, O, focal_length=None):
     model = line.fit_poly()
     x0, _ = line[0].base_point() + 5
     x1, _ = line[-1].base_point() - 5
     domain = np.linspace(x0, x1, len(line))
     points = np.stack([domain, model(domain)])
-    return image_to_focal_plane(points, O)
+    return image_to_focal_plane(points, O, focal_length)
 
-def line_base_points(line, O):
-    return image_to_focal_plane(line.base_points().T, O)
+def line_base_points(line, O, focal_length=None):
+    return image_to_focal_plane(line.base_points().T, O, focal_length)
 
 # represents g(x) = 1/w h(wx)
 class NormPoly(object):
@@ -264,6 +341,11 @@ class NormPoly(object):
     def split(self):
         return False
 
+    # dg/da_m at xs (N x degree); the constant term is not a parameter.
+    def basis(self, xs):
+        return np.stack([xs ** m * self.omega ** (m - 1)
+                         for m in range(1, len(self.coef))], axis=1)
+
     @property
     def coef(self):
         return self.h.coef
@@ -290,44 +372,282 @@ class SplitPoly(object):
     def split(self):
         return True
 
+    def basis(self, xs):
+        on_left = (xs <= self.T)[:, newaxis]
+        return np.concatenate([
+            np.where(on_left, self.left.basis(xs - self.T), 0),
+            np.where(on_left, 0, self.right.basis(xs - self.T)),
+        ], axis=1)
+
+# B-spline basis functions of knots t and degree k at xs, as CSR (N x
+# coefficients): the spline with identity coefficients, which works back to
+# scipy 1.4 (BSpline.design_matrix needs 1.10 for extrapolate).
+def bspline_basis(xs, t, k):
+    n_coef = len(t) - k - 1
+    identity = interpolate.BSpline(t, np.eye(n_coef), k, extrapolate=True)
+    return sparse.csr_matrix(identity(xs))
+
+# Cubic B-spline g(x) = s(x) - offset (scipy BSpline s). Local support: each
+# point meets 4 coefficients, so evaluation is O(1) and basis() is sparse.
+# free: coefficients that are parameters (the rest are pinned at 0); T: the
+# gutter of a spread, where a full-multiplicity knot lets the surface crease.
+class SplineSurface(object):
+    def __init__(self, spline, free, offset=0., offset_basis=None, T=None):
+        self.spline = spline
+        self.free = free
+        self.offset = offset
+        self.offset_basis = offset_basis  # d offset / d free coefficients
+        self.T = T
+
+    def __call__(self, x):
+        return self.spline(x) - self.offset
+
+    # dg/dx as a callable. BSpline.derivative() rejects the two-page
+    # spline's full-multiplicity gutter knot, so evaluate with nu=1 instead.
+    def deriv(self):
+        return lambda x: self.spline(x, nu=1)
+
+    def degree(self):
+        return self.spline.k
+
+    def split(self):
+        return self.T is not None
+
+    # dg/dc at xs as CSR (N x free coefficients).
+    def basis(self, xs):
+        design = bspline_basis(xs, self.spline.t, self.spline.k)[:, self.free]
+        if self.offset_basis is not None:
+            design = design - sparse.csr_matrix(
+                np.ones((xs.shape[0], 1))).dot(self.offset_basis)
+        return sparse.csr_matrix(design)
+
+    # newton.t_i_k for this surface: vectorized Newton in t from t0s, kept
+    # where it converges to a root with no sign change between it and t = 0;
+    # other points (and cold ones, t0 not finite) take the largest negative
+    # root by bisection. Updates t0s and adds to stats like t_i_k.
+    def t_i_k(self, R, points, t0s, focal_length, stats=None):
+        rays = R.dot(points)
+        ROf = R.dot(np.array([0, 0, focal_length], dtype=np.float64))
+        rays_x, rays_z = rays[0], rays[2]
+        gp = self.deriv()
+
+        def residual(t, idx):
+            return self(rays_x[idx] * t - ROf[0]) - (rays_z[idx] * t - ROf[2])
+
+        n = points.shape[1]
+        cold = ~np.isfinite(t0s)
+        ts = np.where(cold, -1., t0s)
+        iters = np.zeros(n, dtype=np.int64)
+        active = np.flatnonzero(~cold)
+        for _ in range(SPLINE_NEWTON_ITERS):
+            y = residual(ts[active], active)
+            unsolved = np.abs(y) >= 1e-6
+            active, y = active[unsolved], y[unsolved]
+            if active.shape[0] == 0: break
+            yp = gp(rays_x[active] * ts[active] - ROf[0]) * rays_x[active] - rays_z[active]
+            ts[active] -= y / yp
+            iters[active] += 1
+
+        bad = cold.copy()
+        bad[active] = True
+        bad |= ~np.isfinite(ts) | (ts >= 0)
+        good = np.flatnonzero(~bad)
+        intermediate = residual(ts[good] * 0.99, good) * residual(ts[good] * 0.01, good) <= 0
+        bad[good[intermediate]] = True
+
+        escapes = 0
+        if bad.any():
+            escapes = self.bracket_roots(ts, np.flatnonzero(bad), residual)
+
+        ts_XYZ = ts * rays - ROf[:, newaxis]
+        big_ys = np.count_nonzero(np.abs(self(ts_XYZ[0]) - ts_XYZ[2]) > 1e-4)
+        t0s[:] = ts
+
+        if stats is not None:
+            stats[newton.SOLVES] += n
+            stats[newton.COLD] += np.count_nonzero(cold)
+            stats[newton.FALLBACKS] += np.count_nonzero(bad)
+            stats[newton.ESCAPES] += escapes
+            stats[newton.BIG_YS] += big_ys
+            warm_iters = np.minimum(iters[~cold], newton.MAX_NEWTON_ITERS)
+            stats[newton.ITERS:] += np.bincount(warm_iters,
+                                                minlength=newton.MAX_NEWTON_ITERS + 1)
+
+        return ts, ts_XYZ
+
+    # Largest negative root of each listed point, bracketed on a grid of t and
+    # bisected; points with no sign change take the grid t nearest a root
+    # (counted as escapes). Writes into ts.
+    @staticmethod
+    def bracket_roots(ts, idx, residual):
+        grid = -np.linspace(SPLINE_T_RANGE, 0, SPLINE_T_STEPS, endpoint=False)
+        ys = np.stack([residual(np.full(idx.shape, t), idx) for t in grid], axis=1)
+        changes = np.signbit(ys[:, 1:]) != np.signbit(ys[:, :-1])
+        has_root = changes.any(axis=1)
+
+        # last sign change: closest to t = 0.
+        last = changes.shape[1] - 1 - np.argmax(changes[:, ::-1], axis=1)
+        lo, hi = grid[last], grid[last + 1]
+        y_lo = ys[np.arange(idx.shape[0]), last]
+        for _ in range(SPLINE_BISECTIONS):
+            mid = (lo + hi) / 2
+            y_mid = residual(mid, idx)
+            same = np.signbit(y_mid) == np.signbit(y_lo)
+            lo, y_lo = np.where(same, mid, lo), np.where(same, y_mid, y_lo)
+            hi = np.where(same, hi, mid)
+
+        nearest = grid[np.argmin(np.abs(ys), axis=1)]
+        ts[idx] = np.where(has_root, (lo + hi) / 2, nearest)
+        return np.count_nonzero(~has_root)
+
 def split_lengths(array, lengths):
     return np.split(array, np.cumsum(lengths))
 
 DEGREE = 13
 OMEGA = 1e-1
-def unpack_args(args, n_pages):
-    # theta: 3; a_m: DEGREE; align: 2; l_m: len(lines)
+# family: surface model of a_m (default PolyFamily()).
+def unpack_args(args, n_pages, family=None):
+    if family is None:
+        family = PolyFamily()
+
+    # theta: 3; a_m: family.n_params; align: 2; l_m: len(lines)
     theta, a_m_all, align_all, (T,), l_m = \
-        split_lengths(np.array(args), (3, DEGREE * n_pages, 2 * n_pages, 1))
+        split_lengths(np.array(args), (3, family.n_params * n_pages, 2 * n_pages, 1))
     T = 0
     # theta[1] = 0.
 
     a_ms = np.split(a_m_all, n_pages)
     aligns = align_all.reshape(n_pages, -1)
 
-    if n_pages == 1:
-        g = NormPoly(np.concatenate([[0], a_ms[0]]), OMEGA)
-    elif n_pages == 2:
-        g = SplitPoly(T,
-                      NormPoly(np.concatenate([[0], a_ms[0]]), OMEGA),
-                      NormPoly(np.concatenate([[0], a_ms[1]]), OMEGA))
+    return theta, a_ms, aligns, T, l_m, family.surface(a_ms, T)
+
+# g from per-page coefficients a_m (constant term fixed at 0).
+def make_surface(a_ms, T, omega=OMEGA):
+    polys = [NormPoly(np.concatenate([[0], a_m]), omega) for a_m in a_ms]
+    if len(polys) == 1:
+        return polys[0]
+    else:
+        left, right = polys
+        return SplitPoly(T, left, right)
+
+# Surface families: how a page's coefficients a_m become g, with their
+# optimizer scales and JSON parameters. PolyFamily is NormPoly of degree
+# DEGREE (SplitPoly across a gutter); its x_scale powers are hand-tuned.
+class PolyFamily(object):
+    kind = 'poly'
 
-    return theta, a_ms, aligns, T, l_m, g
+    def __init__(self, degree=DEGREE, omega=OMEGA):
+        self.degree = degree
+        self.omega = omega
 
-E_str_t0s = []
-def E_str_project(R, g, base_points, t0s_idx):
-    global E_str_t0s
-    if len(E_str_t0s) <= t0s_idx:
-        E_str_t0s.extend([None] * (t0s_idx - len(E_str_t0s) + 1))
-    if E_str_t0s[t0s_idx] is None:
-        E_str_t0s[t0s_idx] = \
-            [np.full((points.shape[1],), np.inf) for points in base_points]
+    @property
+    def n_params(self):
+        return self.degree
+
+    def surface(self, a_ms, T):
+        return make_surface(a_ms, T, omega=self.omega)
+
+    def x_scale(self):
+        return 1000 * ((3e-4 / self.omega) ** np.arange(self.degree))
+
+    # Family and a_ms of k g(x / k), the surface seen in an image scaled by k:
+    # g = h(omega x) / omega, so only omega changes.
+    def scaled(self, k, a_ms):
+        return PolyFamily(self.degree, self.omega / k), a_ms
+
+    def params(self):
+        return {'kind': self.kind, 'degree': self.degree, 'omega': self.omega}
+
+# Cubic B-spline (SplineSurface) over surface x in [x0, x1] with n_spans
+# uniform spans per page. One page: coefficients are heights, g(0) = 0 and
+# the middle coefficient is pinned. Two pages: each page spans its side of
+# the gutter T, where a 4-fold knot and zero end coefficients meet.
+SPLINE_SPANS = 6
+SPLINE_X_SCALE = 1000.
+SPLINE_NEWTON_ITERS = 30
+SPLINE_T_RANGE = 4.
+SPLINE_T_STEPS = 80
+SPLINE_BISECTIONS = 50
+class SplineFamily(object):
+    kind = 'spline'
+
+    def __init__(self, x0, x1, n_spans=SPLINE_SPANS):
+        self.x0 = float(x0)
+        self.x1 = float(x1)
+        self.n_spans = n_spans
+
+    @property
+    def n_params(self):
+        return self.n_spans + 2
 
-    # print([point.shape for point in base_points])
-    # print([t0s.shape for t0s in E_str_t0s])
+    @staticmethod
+    def clamped_knots(x0, x1, n_spans):
+        return np.concatenate([[x0] * 3, np.linspace(x0, x1, n_spans + 1), [x1] * 3])
+
+    def surface(self, a_ms, T):
+        k = 3
+        if len(a_ms) == 1:
+            knots = self.clamped_knots(self.x0, self.x1, self.n_spans)
+            pinned = self.n_params // 2
+            coef = np.insert(a_ms[0], pinned, 0.)
+            free = np.delete(np.arange(coef.shape[0]), pinned)
+            spline = interpolate.BSpline(knots, coef, k, extrapolate=True)
+            offset_basis = bspline_basis(np.zeros(1), knots, k)[:, free]
+            return SplineSurface(spline, free, offset=float(spline(0.)),
+                                 offset_basis=offset_basis)
+        else:
+            left, right = a_ms
+            knots = np.concatenate([self.clamped_knots(self.x0, T, self.n_spans),
+                                    self.clamped_knots(T, self.x1, self.n_spans)[4:]])
+            coef = np.concatenate([left, [0., 0.], right])
+            n_side = self.n_params + 1
+            free = np.delete(np.arange(coef.shape[0]), [n_side - 1, n_side])
+            spline = interpolate.BSpline(knots, coef, k, extrapolate=True)
+            return SplineSurface(spline, free, T=T)
+
+    def x_scale(self):
+        return np.full(self.n_params, SPLINE_X_SCALE)
+
+    # As PolyFamily.scaled: knots and coefficients both scale by k.
+    def scaled(self, k, a_ms):
+        return SplineFamily(self.x0 * k, self.x1 * k, self.n_spans), \
+            [a_m * k for a_m in a_ms]
+
+    def params(self):
+        return {'kind': self.kind, 'x0': self.x0, 'x1': self.x1,
+                'n_spans': self.n_spans}
+
+def surface_family(params):
+    params = dict(params)
+    kind = params.pop('kind')
+    return {'poly': PolyFamily, 'spline': SplineFamily}[kind](**params)
+
+# Surface family for Kim2014: 'poly' or 'spline'.
+SURFACE = 'poly'
+# Spline domain: this multiple of the page's focal-plane x extent.
+SPLINE_MARGIN = 1.1
+# Family of kind for a page with focal-plane points point_sets.
+def page_family(kind, point_sets):
+    if kind == 'poly':
+        return PolyFamily()
+
+    xs = np.concatenate([points[0] for points in point_sets])
+    half_width = SPLINE_MARGIN * np.abs(xs).max()
+    return SplineFamily(-half_width, half_width)
+
+# newton.t_i_k for any surface g; polynomial surfaces use the Cython solver.
+def surface_t_i_k(R, g, points, t0s, stats=None, focal_length=None):
+    if focal_length is None:
+        focal_length = f
+    if isinstance(g, SplineSurface):
+        return g.t_i_k(R, points, t0s, focal_length, stats=stats)
+    else:
+        return newton.t_i_k(R, g, points, t0s, focal_length, stats=stats)
 
-    return [newton.t_i_k(R, g, points, t0s) \
-            for points, t0s in zip(base_points, E_str_t0s[t0s_idx])]
+def E_str_project(R, g, base_points, focal_length=None):
+    return [surface_t_i_k(R, g, points, np.full((points.shape[1],), np.inf),
+                          focal_length=focal_length) \
+            for points in base_points]
 
 class Loss(object):
     def __add__(self, other):
@@ -357,6 +677,8 @@ class AddLoss(Loss):
     def jac(self, x, *args):
         a_jac = self.a.jac(x, *args)
         b_jac = self.b.jac(x, *args)
+        if sparse.issparse(a_jac) or sparse.issparse(b_jac):
+            return sparse.vstack((a_jac, b_jac), format='csr')
         return np.concatenate((a_jac, b_jac))
 
 class MulLoss(Loss):
@@ -370,6 +692,24 @@ class MulLoss(Loss):
     def jac(self, x, *args):
         return self.c * self.inner.jac(x, *args)
 
+# Solve over x[free] only; the remaining parameters stay at x_fixed.
+class Fixed(Loss):
+    def __init__(self, inner, x_fixed, free):
+        self.inner = inner
+        self.x_fixed = np.array(x_fixed, dtype=np.float64)
+        self.free = np.flatnonzero(free)
+
+    def full(self, x):
+        x_full = self.x_fixed.copy()
+        x_full[self.free] = x
+        return x_full
+
+    def residuals(self, x):
+        return self.inner.residuals(self.full(x))
+
+    def jac(self, x):
+        return self.inner.jac(self.full(x))[:, self.free]
+
 class DebugLoss(Loss):
     def __init__(self, inner):
         self.inner = inner
@@ -382,137 +722,206 @@ class DebugLoss(Loss):
     def jac(self, *args):
         return self.inner.jac(*args)
 
-class Preproject(Loss):
-    def __init__(self, inner, base_points, n_pages):
-        self.inner = inner
-        self.base_points = base_points
-        self.n_pages = n_pages
-        self.last_x = None
-        self.last_projection = None
+# A page could not be dewarped well enough (or at all) within its budget;
+# callers fall back to plain deskewing.
+class DewarpFailed(Exception):
+    pass
 
-    def project(self, args):
-        theta, _, _, T, l_m, g = unpack_args(args, self.n_pages)
-        # print '    theta:', theta
-        # print '    a_m:', g.coef
+class DeadlineExceeded(DewarpFailed):
+    pass
 
-        if self.last_x is None or self.last_x.shape != args.shape or np.any(args != self.last_x):
-            R = R_theta(theta)
-            self.last_x = args
-            self.last_projection = E_str_project(R, g, self.base_points, 0)
+# A restart abandoned because an earlier one was accepted.
+class RunCancelled(Exception):
+    pass
 
-        return self.last_projection
+# Raises DeadlineExceeded once time.time() passes deadline (if any), or
+# RunCancelled once the threading.Event stop is set, which stops the
+# optimizer at its next evaluation.
+class Deadline(Loss):
+    def __init__(self, inner, deadline, stop=None):
+        self.inner = inner
+        self.deadline = deadline
+        self.stop = stop
 
-    def residuals(self, args):
-        all_ts_surface = self.project(args)
-        _, _, _, T, _, _ = unpack_args(args, self.n_pages)
-        return self.inner.residuals(args, all_ts_surface)
+    def check(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            raise DeadlineExceeded('deadline exceeded during optimization')
+        if self.stop is not None and self.stop.is_set():
+            raise RunCancelled()
 
-    def jac(self, args):
-        all_ts_surface = self.project(args)
-        return self.inner.jac(args, all_ts_surface)
+    def residuals(self, *args):
+        self.check()
+        return self.inner.residuals(*args)
 
-class Regularize_T(Loss):
-    def __init__(self, base_points, n_pages):
-        self.base_points = base_points
+    def jac(self, *args):
+        self.check()
+        return self.inner.jac(*args)
+
+# Everything the loss terms need at one parameter vector: R, dR, g, g' and
+# the surface projections of every registered point set. Computed once per x
+# with a single solver call; Newton warm starts carry over between x's.
+class Projection(object):
+    def __init__(self, n_pages, family=None, focal_length=None):
         self.n_pages = n_pages
+        self.family = family
+        self.f = f if focal_length is None else focal_length
+        self.point_sets = []
+        self.all_points = None
+        self.stats = None  # newton.t_i_k counters of the current run, if any
+        self.reset()
+
+    def reset(self):
+        self.x = None
+        self.t0s = None
+
+    # register focal-plane point sets (each 3 x N); returns the slice of
+    # projected columns they occupy.
+    def add(self, point_sets):
+        start = sum((points.shape[1] for points in self.point_sets))
+        self.point_sets.extend(point_sets)
+        self.all_points = None
+        self.reset()
+        stop = start + sum((points.shape[1] for points in point_sets))
+        return np.s_[start:stop]
+
+    def update(self, x):
+        if self.x is not None and self.x.shape == x.shape and np.all(x == self.x):
+            return self
+
+        if self.all_points is None:
+            self.all_points = np.concatenate(self.point_sets, axis=1)
+        if self.t0s is None:
+            self.t0s = np.full((self.all_points.shape[1],), np.inf)
+
+        self.theta, self.a_ms, self.aligns, self.T, self.l_m, self.g = \
+            unpack_args(x, self.n_pages, self.family)
+        self.R = R_theta(self.theta)
+        self.dR = dR_dtheta(self.theta, self.R)
+        self.gp = self.g.deriv()
+        self.all_ts, self.all_surface = \
+            surface_t_i_k(self.R, self.g, self.all_points, self.t0s, stats=self.stats,
+                          focal_length=self.f)
+        self.x = x.copy()
+
+        return self
+
+    def __len__(self):
+        return len(self.x)
+
+    # ts and surface points (3 x N) of a registered slice.
+    def ts_surface(self, columns):
+        return self.all_ts[columns], self.all_surface[:, columns]
+
+# least_squares-facing wrapper: x -> shared Projection -> inner loss.
+class Projected(Loss):
+    def __init__(self, inner, projection):
+        self.inner = inner
+        self.projection = projection
 
-    def residuals(self, args, line_ts_surface):
-        residuals = [ts + 1 for ts, _ in line_ts_surface]
-        return np.concatenate(residuals)
+    def residuals(self, x):
+        return self.inner.residuals(self.projection.update(x))
 
-    def jac(self, args, line_ts_surface):
-        theta, a_m, _, T, l_m, g = unpack_args(args, self.n_pages)
-        R = R_theta(theta)
-        dR = dR_dtheta(theta, R)
+    def jac(self, x):
+        return self.inner.jac(self.projection.update(x))
 
-        gp = g.deriv()
+class Regularize_T(Loss):
+    def __init__(self, base_points, projection):
+        self.base_points = base_points
+        self.all_points = np.concatenate(base_points, axis=1)
+        self.columns = projection.add(base_points)
 
-        all_points = np.concatenate(self.base_points, axis=1)
-        all_ts = np.concatenate([ts for ts, _ in line_ts_surface])
-        all_surface = np.concatenate([surface for _, surface in line_ts_surface],
-                                     axis=1)
+    def residuals(self, p):
+        all_ts, _ = p.ts_surface(self.columns)
+        return all_ts + 1
 
-        dtheta = dti_dtheta(theta, R, dR, g, gp, all_points, all_ts, all_surface).T
+    def jac(self, p):
+        all_ts, all_surface = p.ts_surface(self.columns)
+        dtheta = dti_dtheta(p.theta, p.R, p.dR, p.g, p.gp, self.all_points, all_ts,
+                            all_surface, p.f).T
         # dtheta[:, 1] = 0
 
-        return np.concatenate((
+        return hstack_blocks((
             dtheta,
-            dti_dam(R, g, gp, all_points, all_ts, all_surface).T,
-            np.zeros((all_ts.shape[0], 2 * self.n_pages + 1 + len(self.base_points)),
+            dti_dam(p.R, p.g, p.gp, self.all_points, all_ts, all_surface),
+            np.zeros((all_ts.shape[0], 2 * p.n_pages + 1 + len(self.base_points)),
                      dtype=np.float64),
-        ), axis=1)
+        ))
 
 OUTER_LINE_WEIGHT = 2
 def line_weights(points):
     return 1 + np.abs(np.linspace(-OUTER_LINE_WEIGHT + 1, OUTER_LINE_WEIGHT - 1, points.shape[-1]))
 
 class E_str(Loss):
-    def __init__(self, base_points, n_pages, weight_outer=True, scale_t=False):
+    def __init__(self, base_points, projection, weight_outer=True, scale_t=False,
+                 sparse=False, point_weights=None):
         self.base_points = base_points
         self.all_points = np.concatenate(base_points, axis=1)
         self.all_weights = np.concatenate([line_weights(line) for line in self.base_points])
-        self.n_pages = n_pages
+        # e.g. from subsample_points; stands in for the dropped points.
+        self.point_weights = np.ones(self.all_points.shape[1]) \
+            if point_weights is None else point_weights
+        lengths = [points.shape[1] for points in base_points]
+        self.line_index = np.repeat(np.arange(len(base_points)), lengths)
+        self.columns = projection.add(base_points)
         self.weight_outer = weight_outer  # Weight outer letters in line more heavily
         self.scale_t = scale_t  # Scale by - 1 / t
+        self.sparse = sparse  # Return CSR jacobian; each l_k only hits its line
 
     # l_m = fake parameter representing line position
     # base_points = text base points on focal plane
-    @staticmethod
-    def unpacked(all_ts_surface, l_m):
-        assert len(all_ts_surface) == l_m.shape[0]
+    def unpacked(self, p):
+        assert len(self.base_points) == p.l_m.shape[0]
 
-        residuals = [Ys - l_k for (_, (_, Ys, _)), l_k in zip(all_ts_surface, l_m)]
-        return np.concatenate(residuals)
+        _, (_, Ys, _) = p.ts_surface(self.columns)
+        return Ys - p.l_m[self.line_index]
 
-    def residuals(self, args, all_ts_surface):
-        theta, _, _, T, l_m, g = unpack_args(args, self.n_pages)
-        result = E_str.unpacked(all_ts_surface, l_m)
+    def residuals(self, p):
+        result = self.unpacked(p) * self.point_weights
 
         if self.weight_outer:
             result *= self.all_weights
 
         if self.scale_t:
-            all_ts = np.concatenate([ts for ts, _ in all_ts_surface])
+            all_ts, _ = p.ts_surface(self.columns)
             result /= -all_ts
 
         return result
 
-    def jac(self, args, all_ts_surface):
-        theta, a_m, _, T, l_m, g = unpack_args(args, self.n_pages)
-        R = R_theta(theta)
-        dR = dR_dtheta(theta, R)
-
-        gp = g.deriv()
+    def jac(self, p):
+        theta, R, dR, g, gp = p.theta, p.R, p.dR, p.g, p.gp
+        all_ts, all_surface = p.ts_surface(self.columns)
+        residuals = self.unpacked(p)
 
-        all_ts = np.concatenate([ts for ts, _ in all_ts_surface])
-        all_surface = np.concatenate([surface for _, surface in all_ts_surface],
-                                     axis=1)
-        residuals = E_str.unpacked(all_ts_surface, l_m)
-
-        dtheta = dE_str_dtheta(theta, R, dR, g, gp, self.all_points, all_ts, all_surface)
+        dtheta = dE_str_dtheta(theta, R, dR, g, gp, self.all_points, all_ts, all_surface,
+                               p.f)
         dam = dE_str_dam(R, g, gp, self.all_points, all_ts, all_surface)
         # dtheta[:, 1] = 0
 
         if self.scale_t:
-            dtheta -= residuals[:, newaxis] / all_ts[:, newaxis] * dti_dtheta(theta, R, dR, g, gp, self.all_points, all_ts, all_surface).T
-            dam -= residuals[:, newaxis] / all_ts[:, newaxis] * dti_dam(R, g, gp, self.all_points, all_ts, all_surface).T
+            dtheta -= residuals[:, newaxis] / all_ts[:, newaxis] * dti_dtheta(theta, R, dR, g, gp, self.all_points, all_ts, all_surface, p.f).T
+            dam = dam - scale_rows(dti_dam(R, g, gp, self.all_points, all_ts, all_surface),
+                                   residuals / all_ts)
+
+        row_scale = self.point_weights.astype(np.float64)
+        if self.weight_outer:
+            row_scale *= self.all_weights
+
+        if self.scale_t:
+            row_scale /= -all_ts
 
-        result = np.concatenate((
+        blocks = [scale_rows(block, row_scale) for block in (
             dtheta,
             dam,
             # Doesn't depend on alignment:
-            np.zeros((all_ts.shape[0], 2 * self.n_pages), dtype=np.float64),
+            np.zeros((all_ts.shape[0], 2 * p.n_pages), dtype=np.float64),
             dE_str_dT(R, g, gp, self.all_points, all_ts, all_surface),
-            dE_str_dl_k(self.base_points),
-        ), axis=1)
-
-        if self.weight_outer:
-            result *= self.all_weights[:, newaxis]
+        )]
+        if self.sparse:
+            dl_k = dE_str_dl_k_sparse(self.base_points, row_scale)
+        else:
+            dl_k = dE_str_dl_k(self.base_points) * row_scale[:, newaxis]
 
-        if self.scale_t:
-            result /= -all_ts[:, newaxis]
-
-        return result
+        return hstack_blocks(blocks + [dl_k], as_sparse=self.sparse)
 
 def dR_dthetai(theta, R, i):
     T = norm(theta)
@@ -523,10 +932,49 @@ def dR_dthetai(theta, R, i):
     Rm = R_theta(theta - delta)
     return (Rp - Rm) / (2 * inc)
 
-def dR_dtheta(theta, R):
-    return np.array([dR_dthetai(theta, R, i) for i in range(3)])
+# d/dtheta_i of R_theta's entries, exactly as R_theta writes them; result is
+# 3 derivs x 3 x 3. Entries are P(u) sin^2(T/2) + Q(u) sin(T/2)cos(T/2) + c
+# with u = theta / T.
+def dR_dtheta(theta, R=None):
+    T = norm(theta)
+    u1, u2, u3 = u = theta / T
+    A = np.sin(T / 2) ** 2
+    B = np.sin(T / 2) * np.cos(T / 2)
+    dA_dT = B
+    dB_dT = np.cos(T) / 2
+
+    P = 2 * np.array([
+        [u1 * u1 - 1, u1 * u2, u1 * u3],
+        [u1 * u2, u2 * u2 - 1, u2 * u3],
+        [u1 * u2, u2 * u3, u3 * u3 - 1],
+    ])
+    Q = 2 * np.array([
+        [0, -u3, u2],
+        [u3, 0, -u1],
+        [-u2, u1, 0],
+    ])
+    dP_du = 2 * np.array([
+        [[2 * u1, u2, u3], [u2, 0, 0], [u2, 0, 0]],
+        [[0, u1, 0], [u1, 2 * u2, u3], [u1, u3, 0]],
+        [[0, 0, u1], [0, 0, u2], [0, u2, 2 * u3]],
+    ])
+    dQ_du = 2 * np.array([
+        [[0, 0, 0], [0, 0, -1], [0, 1, 0]],
+        [[0, 0, 1], [0, 0, 0], [-1, 0, 0]],
+        [[0, -1, 0], [1, 0, 0], [0, 0, 0]],
+    ])
+
+    du_dtheta = (np.eye(3) - np.outer(u, u)) / T  # [i, k] = du_k / dtheta_i
+    dP = np.tensordot(du_dtheta, dP_du, axes=1)
+    dQ = np.tensordot(du_dtheta, dQ_du, axes=1)
+    dT = u[:, newaxis, newaxis]
+
+    return dP * A + P * dA_dT * dT + dQ * B + Q * dB_dT * dT
+
+def dti_dtheta(theta, R, dR, g, gp, all_points, all_ts, all_surface, focal_length=None):
+    if focal_length is None:
+        focal_length = f
 
-def dti_dtheta(theta, R, dR, g, gp, all_points, all_ts, all_surface):
     R1, _, R3 = R
     dR1, dR3 = dR[:, 0], dR[:, 2]
     dR13, dR33 = dR[:, 0, 2], dR[:, 2, 2]
@@ -536,60 +984,73 @@ def dti_dtheta(theta, R, dR, g, gp, all_points, all_ts, all_surface):
     # dR: 3derivs x r__; dR[:, 0]: 3derivs x r1_; points: 3comps x Npoints
     # A: 3 x Npoints
     A1 = dR1.dot(all_points) * all_ts
-    A2 = -dR13 * f
+    A2 = -dR13 * focal_length
     A = A1 + A2[:, newaxis]
     B = R1.dot(all_points)
     C1 = dR3.dot(all_points) * all_ts  # 3derivs x Npoints
-    C2 = -dR33 * f
+    C2 = -dR33 * focal_length
     C = C1 + C2[:, newaxis]
     D = R3.dot(all_points)
     slopes = gp(Xs)
     return -(C - slopes * A) / (D - slopes * B)
 
-def dE_str_dtheta(theta, R, dR, g, gp, all_points, all_ts, all_surface):
+def dE_str_dtheta(theta, R, dR, g, gp, all_points, all_ts, all_surface, focal_length=None):
+    if focal_length is None:
+        focal_length = f
     _, R2, _ = R
     dR2 = dR[:, 1]
     dR23 = dR[:, 1, 2]
 
-    dt = dti_dtheta(theta, R, dR, g, gp, all_points, all_ts, all_surface)
+    dt = dti_dtheta(theta, R, dR, g, gp, all_points, all_ts, all_surface, focal_length)
 
     term1 = dR2.dot(all_points) * all_ts
     term2 = R2.dot(all_points) * dt
-    term3 = -dR23 * f
+    term3 = -dR23 * focal_length
 
     return term1.T + term2.T + term3
 
+# M * v[:, newaxis] for dense or sparse M.
+def scale_rows(M, v):
+    if sparse.issparse(M):
+        return sparse.csr_matrix(sparse.diags(v).dot(M))
+    else:
+        return M * v[:, newaxis]
+
+# Jacobian blocks side by side; CSR if as_sparse, else dense.
+def hstack_blocks(blocks, as_sparse=False):
+    if as_sparse:
+        return sparse.hstack([sparse.csr_matrix(b) for b in blocks], format='csr')
+    else:
+        return np.concatenate([dense_array(b) for b in blocks], axis=1)
+
+# dt_i/da_m as N x n_params; sparse when g.basis is (e.g. SplineSurface).
 def dti_dam(R, g, gp, all_points, all_ts, all_surface):
     R1, R2, R3 = R
 
     Xs, _, _ = all_surface
 
     denom = R3.dot(all_points) - gp(Xs) * R1.dot(all_points)
-    if isinstance(g, SplitPoly):
-        powers = np.vstack([(Xs - g.T) ** m * g.left.omega ** (m - 1)
-                            for m in range(1, DEGREE + 1)])
-        ratio = powers / denom
-        # print('on left:', np.count_nonzero(Xs <= g.T))
-        # print('on right:', np.count_nonzero(Xs > g.T))
-        left_block = np.where(Xs <= g.T, ratio, 0)
-        right_block = np.where(Xs > g.T, ratio, 0)
-        return np.concatenate([left_block, right_block])
-    else:
-        powers = np.vstack([Xs ** m * g.omega ** (m - 1)
-                            for m in range(1, DEGREE + 1)])
-        return powers / denom
+    return scale_rows(g.basis(Xs), 1 / denom)
 
 def dE_str_dam(R, g, gp, all_points, all_ts, all_surface):
     R1, R2, R3 = R
 
     dt = dti_dam(R, g, gp, all_points, all_ts, all_surface)
 
-    return (R2.dot(all_points) * dt).T
+    return scale_rows(dt, R2.dot(all_points))
 
 def dE_str_dl_k(base_points):
     blocks = [np.full((l.shape[-1], 1), -1) for l in base_points]
     return block_diag(*blocks)
 
+# dE_str_dl_k as CSR, with rows scaled by row_scale.
+def dE_str_dl_k_sparse(base_points, row_scale):
+    lengths = [l.shape[-1] for l in base_points]
+    n_rows = sum(lengths)
+    cols = np.repeat(np.arange(len(lengths)), lengths)
+    return sparse.csr_matrix((-row_scale, (np.arange(n_rows), cols)),
+                             shape=(n_rows, len(lengths)))
+
 def dE_str_dT(R, g, gp, all_points, all_ts, all_surface):
     R1, R2, R3 = R
 
@@ -676,53 +1137,39 @@ def debug_jac(theta, R, g, l_m, base_points, line_ts_surface):
             - E_str(theta, SplitPoly(g.T - inc, g.left, g.right), l_m, base_points)
         print(diff / (2 * inc))
 
-E_align_t0s = []
-def E_align_project(R, g, all_points, t0s_idx):
-    global E_align_t0s
-    if len(E_align_t0s) <= t0s_idx:
-        E_align_t0s.extend([None] * (t0s_idx - len(E_align_t0s) + 1))
-    if E_align_t0s[t0s_idx] is None:
-        E_align_t0s[t0s_idx] = np.full((all_points.shape[1],), np.inf)
-
-    return newton.t_i_k(R, g, all_points, E_align_t0s[t0s_idx])
-
 class E_align_page(Loss):
-    def __init__(self, side_points, side_index, n_pages, page_index, n_total_lines):
+    def __init__(self, side_points, side_index, n_pages, page_index, n_total_lines,
+                 projection, sparse=False):
         self.side_points = side_points
         self.side_index = side_index
         self.n_pages = n_pages
         self.page_index = page_index
         self.n_total_lines = n_total_lines
+        self.columns = projection.add([side_points])
+        self.sparse = sparse
 
-        self.project_index = page_index * 2 + side_index
-
-    def E_align(self, theta, g, align):
-        R = R_theta(theta)
-
-        _, (Xs, _, _) = E_align_project(R, g, self.side_points, self.project_index)
-        return Xs - align
-
-    def residuals(self, args):
-        theta, _, align_all, T, _, g = unpack_args(args, self.n_pages)
-        return self.E_align(theta, g, align_all[self.page_index, self.side_index])
+    def residuals(self, p):
+        _, (Xs, _, _) = p.ts_surface(self.columns)
+        return Xs - p.aligns[self.page_index, self.side_index]
 
     def dE_align_dam(self, theta, R, g, gp, all_ts, all_surface):
         R1, _, _ = R
 
         dt = dti_dam(R, g, gp, self.side_points, all_ts, all_surface)
 
-        return (R1.dot(self.side_points) * dt).T
+        return scale_rows(dt, R1.dot(self.side_points))
 
-    def dE_align_dtheta(self, theta, R, dR, g, gp, all_ts, all_surface):
+    def dE_align_dtheta(self, theta, R, dR, g, gp, all_ts, all_surface, focal_length):
         R1, _, _ = R
         dR1 = dR[:, 0]
         dR13 = dR[:, 0, 2]
 
-        dt = dti_dtheta(theta, R, dR, g, gp, self.side_points, all_ts, all_surface)
+        dt = dti_dtheta(theta, R, dR, g, gp, self.side_points, all_ts, all_surface,
+                        focal_length)
 
         term1 = dR1.dot(self.side_points) * all_ts
         term2 = R1.dot(self.side_points) * dt
-        term3 = -dR13 * f
+        term3 = -dR13 * focal_length
 
         return term1.T + term2.T + term3
 
@@ -749,27 +1196,33 @@ class E_align_page(Loss):
         return np.zeros(result.shape, dtype=np.float64)
         return result
 
-    def jac(self, args):
-        theta, a_m, _, _, _, g = unpack_args(args, self.n_pages)
-
-        R = R_theta(theta)
-        dR = dR_dtheta(theta, R)
-        gp = g.deriv()
+    def jac(self, p):
+        theta, R, dR, g, gp = p.theta, p.R, p.dR, p.g, p.gp
 
         N_residuals = self.side_points.shape[-1]
 
-        all_ts, all_surface = E_align_project(R, g, self.side_points, self.project_index)
+        all_ts, all_surface = p.ts_surface(self.columns)
 
-        return np.concatenate((
-            self.dE_align_dtheta(theta, R, dR, g, gp, all_ts, all_surface),
+        blocks = [
+            self.dE_align_dtheta(theta, R, dR, g, gp, all_ts, all_surface, p.f),
             self.dE_align_dam(theta, R, g, gp, all_ts, all_surface),
             self.dE_align_dalign(),
             self.dE_align_dT(R, g, gp, all_ts, all_surface),
-            np.zeros((N_residuals, self.n_total_lines), dtype=np.float64)  # dl_k
-        ), axis=1)
+        ]
+
+        # dl_k is identically zero.
+        if self.sparse:
+            dl_k = sparse.csr_matrix((N_residuals, self.n_total_lines))
+        else:
+            dl_k = np.zeros((N_residuals, self.n_total_lines), dtype=np.float64)
+
+        return hstack_blocks(blocks + [dl_k], as_sparse=self.sparse)
 
 INLIER_THRESHOLD = 0.5
-def make_E_align_page(page, AH, O, n_pages, page_index, n_total_lines):
+# RANSAC-filtered left/right line ends of page on the focal plane, as
+# (side index, 3 x N points) for each side with enough inliers. bw: page
+# image for debug output.
+def page_side_points(page, AH, O, bw=None, focal_length=None):
     # line left-mid and right-mid points on focal plane.
     # (LR 2, line N, coord 2)
     side_points_2d = [
@@ -780,7 +1233,7 @@ def make_E_align_page(page, AH, O, n_pages, page_index, n_total_lines):
     side_inliers = [ransac(coords, LinearXModel, 3, AH / 5.0)[1] for coords in side_points_2d]
     inlier_use = [inliers.mean() > INLIER_THRESHOLD for inliers in side_inliers]
 
-    if lib.debug:
+    if lib.debug and bw is not None:
         debug = cv2.cvtColor(bw, cv2.COLOR_GRAY2BGR)
         for line, inlier in zip(page, side_inliers[0]):
             draw_circle(debug, line.left_mid(), color=lib.GREEN if inlier else lib.RED)
@@ -794,30 +1247,101 @@ def make_E_align_page(page, AH, O, n_pages, page_index, n_total_lines):
 
     # axes (coord 3, line N)
     side_points = [
-        image_to_focal_plane(points, O) for points in side_points_2d_filtered
+        image_to_focal_plane(points, O, focal_length) for points in side_points_2d_filtered
     ]
 
     return [
-        E_align_page(points, i, n_pages, page_index, n_total_lines)
+        (i, points)
         for i, (points, use) in enumerate(zip(side_points, inlier_use)) if use
     ]
 
-def make_E_align(pages, AH, O):
-    n_pages = len(pages)
-    n_total_lines = sum((len(page) for page in pages)) + \
-        sum((sum((len(line.underlines) for line in page)) for page in pages))
-    losses = sum([
-        make_E_align_page(page, AH, O, n_pages, i, n_total_lines) \
-        for i, page in enumerate(pages)
-    ], [])
+# side_points: page_side_points of each page.
+def make_E_align(side_points, n_total_lines, projection, sparse=False):
+    n_pages = len(side_points)
+    losses = [
+        E_align_page(points, i, n_pages, page_index, n_total_lines, projection,
+                     sparse=sparse) \
+        for page_index, page_sides in enumerate(side_points) \
+        for i, points in page_sides
+    ]
     return sum(losses, NullLoss())
 
-def make_mesh_XYZ(xs, ys, g):
-    return np.array([
-        np.tile(xs, [len(ys), 1]),
-        np.tile(ys, [len(xs), 1]).T,
-        np.tile(g(xs), [len(ys), 1])
-    ])
+# Evenly spaced subset of each point set (3 x N), keeping both ends: at most
+# per_set points from each and max_points overall (but at least two per set).
+# Returns the subsets and per-point weights sqrt(N / kept), which keep each
+# set's share of a sum of squares.
+def subsample_points(point_sets, per_set=None, max_points=None):
+    lengths = np.array([points.shape[1] for points in point_sets])
+    caps = lengths.copy()
+    if per_set is not None:
+        caps = np.minimum(caps, per_set)
+
+    if max_points is not None and caps.sum() > max_points:
+        # largest uniform cap that fits the budget.
+        lo, hi = 2, caps.max()
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if np.minimum(caps, mid).sum() <= max_points:
+                lo = mid
+            else:
+                hi = mid - 1
+        caps = np.minimum(caps, lo)
+
+    subsets, weights = [], []
+    for points, n, k in zip(point_sets, lengths, caps):
+        indices = np.unique(np.round(np.linspace(0, n - 1, k)).astype(int))
+        subsets.append(points[:, indices])
+        weights.append(np.full(len(indices), np.sqrt(n / len(indices))))
+
+    return subsets, np.concatenate(weights)
+
+# Output mesh over the page surface (X, Y, g(X)) for columns xs and rows ys.
+# X and Z depend only on the column and Y only on the row, so R^-1 P + Of is
+# a 3 x W column term plus a 3 x H row term; image coordinates are formed
+# from them band by band in float32 instead of as a 3 x H x W array.
+# focal_length defaults to the global f.
+class SeparableMesh(object):
+    def __init__(self, xs, ys, g, O, R, focal_length=None):
+        self.f = f if focal_length is None else focal_length
+        R_inv = inv(R)
+        self.cols = R_inv[:, 0:1] * xs + R_inv[:, 2:3] * g(xs)
+        self.cols[2] += self.f
+        self.rows = R_inv[:, 1:2] * ys
+        self.O = O
+
+    @property
+    def shape(self):
+        return self.rows.shape[1], self.cols.shape[1]
+
+    # image (xs, ys) of output rows y0:y1, as float32 arrays.
+    def band(self, y0, y1):
+        cols = self.cols.astype(np.float32)
+        rows = self.rows[:, y0:y1].astype(np.float32)
+        points = cols[:, newaxis, :] + rows[:, :, newaxis]
+        scale = np.float32(-self.f) / points[2]
+        return points[0] * scale + np.float32(self.O[0]), \
+            points[1] * scale + np.float32(self.O[1])
+
+    # image coordinates at rows x cols (float64), as len(rows) x len(cols) x 2.
+    def sample(self, row_indices, col_indices):
+        points = self.cols[:, newaxis, col_indices] + \
+            self.rows[:, row_indices, newaxis]
+        return project_to_image(points, self.O, self.f).transpose(1, 2, 0)
+
+    # image coordinates of one output column / row (float64).
+    def column(self, j):
+        points = self.cols[:, [j]] + self.rows
+        return project_to_image(points, self.O, self.f)
+
+    def row(self, i):
+        points = self.cols + self.rows[:, [i]]
+        return project_to_image(points, self.O, self.f)
+
+    def flip_columns(self):
+        self.cols = self.cols[:, ::-1]
+
+    def flip_rows(self):
+        self.rows = self.rows[:, ::-1]
 
 def normalize_theta(theta):
     angle = norm(theta)
@@ -825,7 +1349,7 @@ def normalize_theta(theta):
     mod = angle - 2 * pi * quot
     return theta * (mod / angle)
 
-def debug_print_points(filename, points, step=None, color=BLUE):
+def debug_print_points(filename, bw, points, step=None, color=BLUE):
     if lib.debug:
         debug = cv2.cvtColor(bw, cv2.COLOR_GRAY2BGR)
         if step is not None:
@@ -834,13 +1358,16 @@ def debug_print_points(filename, points, step=None, color=BLUE):
             draw_circle(debug, p, color=color)
         lib.debug_imwrite(filename, debug)
 
-# @lib.timeit
-def make_mesh_2d(all_lines, O, R, g, n_points_w=None):
+# Text box of the page(s) on the surface (X, Y), one Crop per side of a
+# SplitPoly: surface points under every letter corner that projects cleanly.
+def surface_boxes(all_lines, O, R, g, bw=None, focal_length=None):
+    if focal_length is None:
+        focal_length = f
     all_letters = np.concatenate([line.letters for line in all_lines])
     corners_2d = np.concatenate([letter.corners() for letter in all_letters]).T
-    corners = image_to_focal_plane(corners_2d, O)
+    corners = image_to_focal_plane(corners_2d, O, focal_length)
     t0s = np.full((corners.shape[1],), np.inf, dtype=np.float64)
-    corners_t, corners_XYZ = newton.t_i_k(R, g, corners, t0s)
+    corners_t, corners_XYZ = surface_t_i_k(R, g, corners, t0s, focal_length=focal_length)
 
     corners_X, _, corners_Z = corners_XYZ
     relative_Z_error = np.abs(g(corners_X) - corners_Z) / corners_Z
@@ -849,7 +1376,8 @@ def make_mesh_2d(all_lines, O, R, g, n_points_w=None):
                                                 corners_t < 0)]
     corners_X, _, _ = corners_XYZ
 
-    debug_print_points('corners.png', corners_2d)
+    if bw is not None:
+        debug_print_points('corners.png', bw, corners_2d)
 
     if lib.debug:
         try:
@@ -863,11 +1391,12 @@ def make_mesh_2d(all_lines, O, R, g, n_points_w=None):
                 ys = np.full(200, y)
                 zs = g(xs)
                 points = np.stack([xs, ys, zs])
-                points_r = inv(R).dot(points) + Of[:, newaxis]
+                points_r = inv(R).dot(points)
+                points_r[2] += focal_length
                 ax.plot(points_r[0], points_r[2])
 
             base_xs = np.array([corners[0].min(), corners[0].max()])
-            base_zs = np.array([-3270.5, -3270.5])
+            base_zs = np.array([-focal_length, -focal_length])
             ax.plot(base_xs, base_zs)
             ax.set_aspect('equal')
             plt.savefig('dewarp/camera.png')
@@ -877,29 +1406,56 @@ def make_mesh_2d(all_lines, O, R, g, n_points_w=None):
             IPython.embed()
 
     if g.split():
-        meshes = [
-            make_mesh_2d_indiv(all_lines, corners_XYZ[:, corners_X <= g.T], O, R, g, n_points_w=n_points_w),
-            make_mesh_2d_indiv(all_lines, corners_XYZ[:, corners_X > g.T], O, R, g, n_points_w=n_points_w),
-        ]
+        sides = [corners_XYZ[:, corners_X <= g.T], corners_XYZ[:, corners_X > g.T]]
     else:
-        meshes = [make_mesh_2d_indiv(all_lines, corners_XYZ, O, R, g, n_points_w=n_points_w)]
+        sides = [corners_XYZ]
 
-    for i, mesh in enumerate(meshes):
-        # debug_print_points('mesh{}.png'.format(i), mesh, step=20)
-        pass
+    return [Crop.from_points(side[:2]) for side in sides]
 
-    return meshes
+# fit_scale: lines are from the source resized by this; the floor is in
+# source pixels.
+def default_mesh_width(all_lines, fit_scale=1.):
+    # 90th percentile line width a good guess
+    n_points_w = 1.2 * np.percentile(np.array([line.width() for line in all_lines]), 90)
+    return max(n_points_w, 1800 * fit_scale)
 
-def make_mesh_2d_indiv(all_lines, corners_XYZ, O, R, g, n_points_w=None):
-    box_XYZ = Crop.from_points(corners_XYZ[:2]).expand(0.01)
+# @lib.timeit
+def make_mesh_2d(all_lines, O, R, g, n_points_w=None, scale=None, margin=0.01,
+                 bw=None, focal_length=None):
+    if n_points_w is None:
+        n_points_w = default_mesh_width(all_lines)
+
+    return [make_mesh_box(box_XY, O, R, g, n_points_w=n_points_w, scale=scale,
+                          margin=margin, focal_length=focal_length)
+            for box_XY in surface_boxes(all_lines, O, R, g, bw=bw,
+                                        focal_length=focal_length)]
+
+# Longest image length (source pixels) of the surface curve (xs, zs) at
+# each height in ys.
+def projected_width(xs, zs, ys, O, R, focal_length=None):
+    widths = []
+    for y in ys:
+        points = np.stack([xs, np.full_like(xs, y), zs])
+        image_points = gcs_to_image(points, O, R, focal_length)
+        widths.append(norm(np.diff(image_points), axis=0).sum())
+    return max(widths)
+
+# Mesh over surface box box_XY. scale: output pixels per source pixel along
+# the box's longest row as projected into the image, which overrides
+# n_points_w. margin: fraction of the box kept around it. focal_length
+# defaults to the global f.
+def make_mesh_box(box_XY, O, R, g, n_points_w, scale=None, margin=0.01,
+                  focal_length=None):
+    box_XYZ = box_XY.expand(margin)
     if lib.debug: print('box_XYZ:', box_XYZ)
 
-    if n_points_w is None:
-        # 90th percentile line width a good guess
-        n_points_w = 1.2 * np.percentile(np.array([line.width() for line in all_lines]), 90)
-        n_points_w = max(n_points_w, 1800)
     mesh_XYZ_x = np.linspace(box_XYZ.x0, box_XYZ.x1, 400)
     mesh_XYZ_z = g(mesh_XYZ_x)
+
+    if scale is not None:
+        edges_y = [box_XYZ.y0, (box_XYZ.y0 + box_XYZ.y1) / 2, box_XYZ.y1]
+        n_points_w = scale * projected_width(mesh_XYZ_x, mesh_XYZ_z, edges_y,
+                                             O, R, focal_length)
     mesh_XYZ_xz_arc, total_arc = arc_length_points(mesh_XYZ_x, mesh_XYZ_z,
                                                    int(n_points_w))
     mesh_XYZ_x_arc, _ = mesh_XYZ_xz_arc
@@ -909,75 +1465,176 @@ def make_mesh_2d_indiv(all_lines, corners_XYZ, O, R, g, n_points_w=None):
     # n_points_h = n_points_w * 1.7
 
     mesh_XYZ_y = np.linspace(box_XYZ.y0, box_XYZ.y1, n_points_h)
-    mesh_XYZ = make_mesh_XYZ(mesh_XYZ_x_arc, mesh_XYZ_y, g)
-    mesh_2d = gcs_to_image(mesh_XYZ, O, R)
-    if lib.debug: print('mesh:', Crop.from_points(mesh_2d))
+    mesh = SeparableMesh(mesh_XYZ_x_arc, mesh_XYZ_y, g, O, R,
+                         focal_length=focal_length)
+    if lib.debug: print('mesh:', mesh.shape)
 
     # make sure meshes are not reversed
-    if mesh_2d[0, :, 0].mean() > mesh_2d[0, :, -1].mean():
-        mesh_2d = mesh_2d[:, :, ::-1]
-
-    if mesh_2d[1, 0].mean() > mesh_2d[1, -1].mean():
-        mesh_2d = mesh_2d[:, ::-1, :]
-
-    return mesh_2d.transpose(1, 2, 0)
-
-def lm(fun, x0, jac, args=(), kwargs={}, ftol=1e-6, max_nfev=10000, x_scale=None,
-       geodesic_accel=False, uphill_steps=False):
-    LAM_UP = 1.5
-    LAM_DOWN = 5.
-
+    if mesh.column(0)[0].mean() > mesh.column(-1)[0].mean():
+        mesh.flip_columns()
+
+    if mesh.row(0)[1].mean() > mesh.row(-1)[1].mean():
+        mesh.flip_rows()
+
+    return mesh
+
+def dense_array(M):
+    return M.toarray() if sparse.issparse(M) else np.asarray(M)
+
+# Normal equations J^T J + lam I of one LM iteration. When each row meets at
+# most one of the last n_block columns (the per-line l_m of E_str), B^T B is
+# diagonal and those columns are eliminated: the products with J are formed
+# once per Jacobian, and each lam only factors the small Schur complement
+# over the leading columns.
+class NormalEquations(object):
+    def __init__(self, J, n_block=0):
+        n = J.shape[1]
+        self.n_lead = n - n_block
+        self.diag = None
+        if n_block > 0:
+            A, B = J[:, :self.n_lead], J[:, self.n_lead:]
+            BtB = sparse.csr_matrix(B.T.dot(B))
+            if (BtB - sparse.diags(BtB.diagonal())).count_nonzero() == 0:
+                self.AtA = dense_array(A.T.dot(A))
+                self.AtB = dense_array(A.T.dot(B))
+                self.diag = BtB.diagonal()
+                self.max_diag = max(np.diag(self.AtA).max(), self.diag.max())
+
+        if self.diag is None:
+            self.n_lead = n
+            self.JtJ = dense_array(J.T.dot(J))
+            self.max_diag = np.diag(self.JtJ).max()
+
+    # solve(g) = (J^T J + lam I)^-1 g, reusing one Cholesky factorization.
+    # Raises LinAlgError if the system is not positive definite.
+    def factor(self, lam):
+        n_lead = self.n_lead
+        if self.diag is None:
+            cho = cho_factor(self.JtJ + lam * np.eye(n_lead))
+            return lambda g: cho_solve(cho, g)
+
+        d = self.diag + lam
+        W = self.AtB / d
+        cho = cho_factor(self.AtA + lam * np.eye(n_lead) - W.dot(self.AtB.T))
+
+        def solve(g):
+            g_lead, g_block = g[:n_lead], g[n_lead:]
+            d_lead = cho_solve(cho, g_lead - W.dot(g_block))
+            d_block = (g_block - self.AtB.T.dot(d_lead)) / d
+            return np.concatenate([d_lead, d_block])
+
+        return solve
+
+# Damping starts at LM_TAU * max diag(J^T J) and follows Nielsen's gain-ratio
+# update. Geodesic acceleration (Transtrum and Sethna 2012) takes a second
+# directional derivative from one extra residual evaluation GEODESIC_H along
+# the step; steps with 2 |a| / |v| > GEODESIC_ALPHA are rejected. Uphill
+# steps use bold acceptance with exponent UPHILL_B.
+LM_TAU = 1e-3
+LM_MAX_LAM = 1e16
+GEODESIC_H = 0.1
+GEODESIC_ALPHA = 0.75
+UPHILL_B = 2
+# Optimizer for Kim2014.optimize: 'trf' (opt.least_squares) or 'lm' (below).
+SOLVER = 'trf'
+
+# Levenberg-Marquardt for fun(x) with jacobian jac(x) (dense or CSR). Same
+# x_scale and ftol/xtol/gtol meaning as opt.least_squares, whose result
+# fields it returns. n_block: trailing parameters eliminated per iteration
+# (see NormalEquations).
+def lm(fun, x0, jac, args=(), kwargs={}, ftol=1e-6, xtol=1e-8, gtol=1e-8,
+       max_nfev=10000, x_scale=None, geodesic_accel=False, uphill_steps=False,
+       n_block=0):
     if x_scale is None:
         x_scale = np.ones(x0.shape[0], dtype=np.float64)
 
-    x = x0
-    xs = x / x_scale
-    lam = 100.
+    def scaled_jac(x):
+        J = jac(x, *args, **kwargs)
+        if sparse.issparse(J):
+            return sparse.csr_matrix(J.dot(sparse.diags(x_scale)))
+        else:
+            return J * x_scale[newaxis, :]
 
+    x = np.array(x0, dtype=np.float64)
     r = fun(x, *args, **kwargs)
     C = dot(r, r) / 2
-    Js = jac(x, *args, **kwargs) * x_scale[newaxis, :]
-    dC = dot(Js.T, r)
-    JsTJs = dot(Js.T, Js)
-    assert r.shape[0] == Js.shape[0]
-
-    I = np.eye(Js.shape[1])
+    J = scaled_jac(x)
+    nfev, njev = 1, 1
+    assert r.shape[0] == J.shape[0]
+
+    normal = NormalEquations(J, n_block)
+    grad = J.T.dot(r)
+    lam, nu = LM_TAU * normal.max_diag, 2.
+    v_prev = None
+
+    status, message = 0, 'The maximum number of function evaluations is exceeded.'
+    while nfev < max_nfev:
+        if norm(grad, np.inf) < gtol:
+            status, message = 1, '`gtol` termination condition is satisfied.'
+            break
+        if lam > LM_MAX_LAM:
+            status, message = -1, 'Damping grew without finding a better point.'
+            break
 
-    for step in range(max_nfev):
-        xs_new = xs - solve(JsTJs + lam * I, dC)
-        x_new = xs_new * x_scale
+        try:
+            solve_normal = normal.factor(lam)
+        except LinAlgError:
+            lam, nu = lam * nu, nu * 2
+            continue
 
+        v = -solve_normal(grad)
+        step = v
+        if geodesic_accel:
+            r_h = fun(x + GEODESIC_H * v * x_scale, *args, **kwargs)
+            nfev += 1
+            r_vv = 2 / GEODESIC_H * ((r_h - r) / GEODESIC_H - J.dot(v))
+            a = -solve_normal(J.T.dot(r_vv))
+            if 2 * norm(a) > GEODESIC_ALPHA * norm(v):
+                lam, nu = lam * nu, nu * 2
+                continue
+            step = v + a / 2
+
+        x_new = x + step * x_scale
         r_new = fun(x_new, *args, **kwargs)
+        nfev += 1
         C_new = dot(r_new, r_new) / 2
-        print('trying step: size {:.3g}, C {:.3g}, lam {:.3g}'.format(
-            norm(x - x_new), C_new, lam
-        ))
-        # print(x - x_new)
-        if C_new >= C:
-            lam *= LAM_UP
-            if lam >= 1e6: break
-            continue
-
-        relative_err = abs(C - C_new) / C
-        if relative_err <= ftol:
-            break
 
-        xs = xs_new
-        print(xs)
-        x = xs * x_scale
-        r = r_new
-
-        C = C_new
+        predicted = dot(v, lam * v - grad) / 2
+        rho = (C - C_new) / predicted if predicted > 0 else -1.
+        if lib.debug:
+            print('lm step: size {:.3g}, C {:.3g}, lam {:.3g}, rho {:.3g}'.format(
+                norm(step), C_new, lam, rho
+            ))
+
+        accept = C_new < C
+        if not accept and uphill_steps and v_prev is not None:
+            cos_beta = dot(v, v_prev) / (norm(v) * norm(v_prev))
+            accept = (1 - cos_beta) ** UPHILL_B * C_new <= C
+        if not accept:
+            lam, nu = lam * nu, nu * 2
+            continue
 
-        if C < 1e-6: break
+        reduction = C - C_new
+        x_norm = norm(x / x_scale)
+        x, r, C, v_prev = x_new, r_new, C_new, v
 
-        Js = jac(x, *args, **kwargs) * x_scale[newaxis, :]
-        dC = dot(Js.T, r)
-        JsTJs = dot(Js.T, Js)
-        lam /= LAM_DOWN
+        if 0 <= reduction < ftol * C and rho > 0.25:
+            status, message = 2, '`ftol` termination condition is satisfied.'
+            break
+        if norm(step) < xtol * (xtol + x_norm):
+            status, message = 3, '`xtol` termination condition is satisfied.'
+            break
 
-    return opt.OptimizeResult(x=x, fun=r)
+        J = scaled_jac(x)
+        njev += 1
+        normal = NormalEquations(J, n_block)
+        grad = J.T.dot(r)
+        if rho > 0:
+            lam *= max(1. / 3, 1 - (2 * rho - 1) ** 3)
+        nu = 2.
 
+    return opt.OptimizeResult(x=x, fun=r, cost=C, nfev=nfev, njev=njev,
+                              status=status, success=status > 0, message=message)
 
 def Jac_to_grad_lsq(residuals, jac, x, args):
     jacobian = jac(x, *args)
@@ -991,11 +1648,142 @@ def lsq(func, jac, x_scale):
 
     return result
 
-def kim2014(orig, O=None, split=True, n_points_w=None):
+# Calibrated camera of a fixed scanning rig: focal length f (pixels),
+# rotation theta and a typical page surface a_m, which starts pages that
+# have no neighbour to warm-start from (a flat start at a locked theta
+# rarely converges). Stored as JSON; see rig.py.
+class RigProfile(object):
+    def __init__(self, f, theta, a_m=None):
+        self.f = float(f)
+        self.theta = np.array(theta, dtype=np.float64)
+        self.a_m = None if a_m is None else np.array(a_m, dtype=np.float64)
+
+    def save(self, path):
+        profile = {'f': self.f, 'theta': list(self.theta)}
+        if self.a_m is not None:
+            profile['a_m'] = list(self.a_m)
+
+        with open(path, 'w') as profile_file:
+            json.dump(profile, profile_file, indent=2)
+
+    @staticmethod
+    def load(path):
+        with open(path) as profile_file:
+            profile = json.load(profile_file)
+        return RigProfile(profile['f'], profile['theta'], profile.get('a_m'))
+
+# Converged (theta, a_m) of each finished page of a book, keyed by page
+# number. Consecutive pages on one rig share camera rotation and similar
+# curvature, so a page starts from its nearest finished neighbour (earlier
+# page on ties). store may be any mapping, e.g. a Manager dict shared by a
+# process pool.
+class BookParams(object):
+    def __init__(self, store=None):
+        self.store = {} if store is None else store
+
+    def record(self, index, page_params):
+        self.store[index] = [(np.array(theta), np.array(a_m)) \
+                             for theta, a_m in page_params]
+
+    def nearest(self, index):
+        finished = [i for i in list(self.store.keys()) if i != index]
+        if not finished:
+            return None
+
+        best = min(finished, key=lambda i: (abs(i - index), i > index))
+        return self.store[best]
+
+NEWTON_COUNTERS = ['solves', 'cold', 'fallbacks', 'escapes', 'big_ys']
+# counters: NEWTON_COUNTERS by name; iters: histogram of Newton iterations
+# per warm-started solve. Rates are over warm-started solves (cold ones
+# always take the root solve) and over all solves.
+def newton_summary(counters, iters):
+    iters = np.asarray(iters, dtype=np.int64)
+    warm = counters['solves'] - counters['cold']
+    summary = dict(counters)
+    summary['iters'] = [int(n) for n in iters]
+    summary['mean_iters'] = float(np.arange(len(iters)).dot(iters) / iters.sum()) \
+        if iters.sum() > 0 else 0.
+    summary['fallback_rate'] = float(counters['fallbacks'] - counters['cold']) / warm \
+        if warm > 0 else 0.
+    summary['escape_rate'] = float(counters['escapes']) / counters['solves'] \
+        if counters['solves'] > 0 else 0.
+    return summary
+
+# Solver telemetry of one page: newton.t_i_k counters summed over its
+# optimizer runs, and per run its seed, warm start, nfev, njev, final norm
+# and wall time. summary() is plain data for metrics files.
+class SolverStats(object):
+    def __init__(self):
+        self.newton = np.zeros(newton.STATS_LEN, dtype=np.int64)
+        self.runs = []
+
+    def add_run(self, final_norm, opt_result):
+        self.newton += opt_result.newton_stats
+        self.runs.append({
+            'seed': int(opt_result.seed),
+            'warm': bool(opt_result.warm),
+            'nfev': int(opt_result.nfev),
+            'njev': int(opt_result.njev),
+            'skipped_levels': int(opt_result.skipped_levels),
+            'final_norm': float(final_norm),
+            'seconds': float(opt_result.seconds),
+        })
+
+    def summary(self):
+        indices = [newton.SOLVES, newton.COLD, newton.FALLBACKS, newton.ESCAPES,
+                   newton.BIG_YS]
+        counters = {name: int(self.newton[i]) for name, i in zip(NEWTON_COUNTERS, indices)}
+        norms = [run['final_norm'] for run in self.runs]
+        return {
+            'restarts': len(self.runs),
+            'nfev': sum(run['nfev'] for run in self.runs),
+            'njev': sum(run['njev'] for run in self.runs),
+            'final_norm': min(norms) if norms else None,
+            'runs': self.runs,
+            'newton': newton_summary(counters, self.newton[newton.ITERS:]),
+        }
+
+# Aggregate of SolverStats summaries over the pages of a run.
+def merge_solver_stats(summaries):
+    if not summaries:
+        return {'pages': 0}
+
+    counters = {name: sum(s['newton'][name] for s in summaries) \
+                for name in NEWTON_COUNTERS}
+    iters = np.sum([s['newton']['iters'] for s in summaries], axis=0)
+    nfevs = [s['nfev'] for s in summaries]
+    restarts = [s['restarts'] for s in summaries]
+    norms = [s['final_norm'] for s in summaries if s['final_norm'] is not None]
+    return {
+        'pages': len(summaries),
+        'nfev': sum(nfevs),
+        'nfev_median': float(np.median(nfevs)),
+        'nfev_max': max(nfevs),
+        'njev': sum(s['njev'] for s in summaries),
+        'restarts': sum(restarts),
+        'restarts_max': max(restarts),
+        'final_norm_median': float(np.median(norms)) if norms else None,
+        'newton': newton_summary(counters, iters),
+    }
+
+# Yields one Kim2014 per page of orig (two for a bimodal spread).
+# fit_scale: fit on orig resized by this (O and n_points_w are still in orig
+# pixels); the dewarpers and their models are in resized pixels.
+# focal_length: in orig pixels; defaults to rig.f, else the global f.
+def page_dewarpers(orig, O=None, split=True, n_points_w=None, seed=0, rig=None,
+                   solver=SOLVER, deadline=None, max_nfev=None, surface=SURFACE,
+                   fit_scale=1., focal_length=None):
+    if fit_scale != 1:
+        orig = cv2.resize(orig, (0, 0), None, fit_scale, fit_scale,
+                          interpolation=cv2.INTER_AREA)
+        if O is not None:
+            O = (np.asarray(O, dtype=np.float64) + 0.5) * fit_scale - 0.5
+        if n_points_w is not None:
+            n_points_w *= fit_scale
+
     lib.debug_imwrite('gray.png', binarize.grayscale(orig))
     im = binarize.binarize(orig, algorithm=lambda im: binarize.sauvola_noisy(im, k=0.1))
-    global bw
-    bw = im
 
     im_h, im_w = im.shape
 
@@ -1012,15 +1800,15 @@ def kim2014(orig, O=None, split=True, n_points_w=None):
     else:
         dual = False
 
+    prefix = lib.current_debug_prefix()
     if dual:
         print('Bimodal! Splitting page!')
         pages = crop.split_lines(lines)
 
-        n_points_w = 1.2 * np.percentile(np.array([line.width() for line in lines]), 90)
-        n_points_w = max(n_points_w, 1800)
+        n_points_w = default_mesh_width(lines, fit_scale)
 
         if lib.debug:
-            debug = cv2.cvtColor(bw, cv2.COLOR_GRAY2BGR)
+            debug = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)
             for page in pages:
                 page_crop = Crop.from_lines(page).expand(0.005)
                 # print(page_crop)
@@ -1030,40 +1818,220 @@ def kim2014(orig, O=None, split=True, n_points_w=None):
         page_crops = [Crop.from_lines(page) for page in pages]
         if len(page_crops) == 2:
             [c0, c1] = page_crops
-            split_x = (c0.x1 + c1.x0) / 2
+            split_x = (c0.x1 + c1.x0) // 2
             page_crops = [
                 c0.union(Crop(0, 0, split_x, im_h)),
                 c1.union(Crop(split_x, 0, im_w, im_h))
             ]
 
-        result = []
         for i, (page, page_crop) in enumerate(zip(pages, page_crops)):
             print('==== PAGE {} ===='.format(i))
-            lib.debug_prefix.append('page{}'.format(i))
-
-            page_image = page_crop.apply(orig)
-            page_bw = page_crop.apply(im)
-            page_AH, page_lines, _ = get_AH_lines(page_bw)
-            new_O = O - np.array((page_crop.x0, page_crop.y0))
-            lib.debug_imwrite('precrop.png', im)
-            lib.debug_imwrite('page.png', page_image)
-
-            bw = page_bw
-            dewarper = Kim2014(page_image, page_bw, page_lines, [page_lines],
-                               new_O, page_AH, n_points_w)
-            result.append(dewarper.run_retry()[0])
-
-            lib.debug_prefix.pop()
-
-        return result
+            with lib.thread_debug_prefix(prefix + ['page{}'.format(i)]):
+                page_image = page_crop.apply(orig)
+                page_bw = page_crop.apply(im)
+                page_AH, page_lines, _ = get_AH_lines(page_bw)
+                new_O = O - np.array((page_crop.x0, page_crop.y0))
+                lib.debug_imwrite('precrop.png', im)
+                lib.debug_imwrite('page.png', page_image)
+
+                dewarper = Kim2014(page_image, page_bw, page_lines, [page_lines],
+                                   new_O, page_AH, n_points_w, seed=seed, rig=rig,
+                                   source_crop=page_crop, solver=solver,
+                                   deadline=deadline, max_nfev=max_nfev,
+                                   surface=surface, fit_scale=fit_scale,
+                                   focal_length=focal_length)
+            yield dewarper
     else:
-        lib.debug_prefix.append('page0')
-        dewarper = Kim2014(orig, im, lines, [lines], O, AH, n_points_w)
-        lib.debug_prefix.pop()
-        return dewarper.run_retry()
+        with lib.thread_debug_prefix(prefix + ['page0']):
+            dewarper = Kim2014(orig, im, lines, [lines], O, AH, n_points_w, seed=seed,
+                               rig=rig, solver=solver, deadline=deadline,
+                               max_nfev=max_nfev, surface=surface,
+                               fit_scale=fit_scale, focal_length=focal_length)
+        yield dewarper
+
+# Dewarp every page of orig. Pages of a spread are independent Kim2014
+# instances, so they are optimized and rendered on separate threads (the
+# numeric kernels release the GIL). Each dewarper carries its own focal
+# length (focal_length, else rig.f, else f), so calls from several threads
+# don't share camera state. If models is a list, each page's DewarpModel is
+# appended to it.
+# If stats is a list, each page's SolverStats summary is appended to it,
+# also when the page fails.
+# Budget: fitting stops time_budget seconds after the call and each
+# optimizer run after max_nfev evaluations; with require_accept (by default,
+# whenever either budget is set), a page whose best run misses ACCEPT_NORM
+# also fails. Failures raise DewarpFailed before anything is rendered.
+# fit_scale < 1 fits on orig resized by it (see page_dewarpers) and renders
+# orig through the model scaled back up, so models are always in orig pixels.
+def kim2014(orig, O=None, split=True, n_points_w=None, seed=0, processes=None,
+            book=None, page_index=None, rig=None, spec=None, models=None,
+            solver=SOLVER, time_budget=None, max_nfev=None, require_accept=None,
+            stats=None, surface=SURFACE, fit_scale=1., focal_length=None):
+    if require_accept is None:
+        require_accept = time_budget is not None or max_nfev is not None
+    deadline = None if time_budget is None else time.time() + time_budget
+    warm = book.nearest(page_index) if book is not None else None
+
+    dewarpers = list(page_dewarpers(orig, O=O, split=split, n_points_w=n_points_w,
+                                    seed=seed, rig=rig, solver=solver,
+                                    deadline=deadline, max_nfev=max_nfev,
+                                    surface=surface, fit_scale=fit_scale,
+                                    focal_length=focal_length))
+
+    def run_page(i):
+        dewarper = dewarpers[i]
+        page_warm = None if warm is None else [warm[min(i, len(warm) - 1)]]
+        with lib.thread_debug_prefix(dewarper.debug_prefix):
+            opt_result = dewarper.fit(processes=processes, warm=page_warm)
+            if require_accept and dewarper.converged() is None:
+                raise DewarpFailed('final norm {:.1f} above {}'.format(
+                    norm(opt_result.fun), dewarper.accept_norm))
+            model = dewarper.model(opt_result)
+            if fit_scale != 1:
+                model = model.scaled(1. / fit_scale)
+                return model, model.render(orig, spec)
+            return model, model.render_page(dewarper.orig, spec)
+
+    try:
+        if len(dewarpers) > 1:
+            pool = ThreadPool(len(dewarpers))
+            try:
+                page_results = pool.map(run_page, range(len(dewarpers)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            page_results = [run_page(i) for i in range(len(dewarpers))]
+    finally:
+        if stats is not None:
+            stats.extend(dewarper.stats.summary() for dewarper in dewarpers)
+
+    page_params = [dewarper.converged() for dewarper in dewarpers]
+    if book is not None and all(params is not None for params in page_params):
+        book.record(page_index, sum(page_params, []))
+
+    if models is not None:
+        models.extend(model for model, _ in page_results)
+
+    return sum((images for _, images in page_results), [])
+
+# What the caller keeps of a dewarped page, so only that is rendered:
+# scale is output pixels per source pixel (e.g. target DPI / source DPI;
+# None keeps the default mesh width), gray renders one channel, margin
+# is the fraction of the projected text box kept around the text, and
+# grid_step (if any) interpolates the remap from a control grid of that
+# spacing (see correct_geometry).
+class RenderSpec(object):
+    def __init__(self, scale=None, gray=False, margin=0.01, grid_step=None):
+        self.scale = scale
+        self.gray = gray
+        self.margin = margin
+        self.grid_step = grid_step
+
+# Everything needed to re-render a fitted page without re-optimizing: camera
+# (focal length f, principal point O, rotation theta), surface g (a_ms, T and
+# the surface family), text box of each side on the surface and default
+# output width.
+# source_crop: the page's crop of the source image, for one page of a
+# spread. Stored as JSON.
+class DewarpModel(object):
+    def __init__(self, f, O, theta, a_ms, T, boxes, n_points_w, family=None,
+                 source_crop=None):
+        self.f = float(f)
+        self.O = np.array(O, dtype=np.float64)
+        self.theta = np.array(theta, dtype=np.float64)
+        self.a_ms = [np.array(a_m, dtype=np.float64) for a_m in a_ms]
+        self.T = float(T)
+        self.boxes = [Crop(*box) for box in boxes]
+        self.n_points_w = float(n_points_w)
+        self.family = PolyFamily() if family is None else family
+        self.source_crop = None if source_crop is None else Crop(*source_crop)
+
+    def save(self, path):
+        model = {
+            'f': self.f,
+            'O': list(self.O),
+            'theta': list(self.theta),
+            'a_ms': [list(a_m) for a_m in self.a_ms],
+            'T': self.T,
+            'boxes': [[float(c) for c in box] for box in self.boxes],
+            'n_points_w': self.n_points_w,
+            'surface': self.family.params(),
+        }
+        if self.source_crop is not None:
+            model['source_crop'] = [int(c) for c in self.source_crop]
+
+        with open(path, 'w') as model_file:
+            json.dump(model, model_file, indent=2)
 
+    @staticmethod
+    def load(path):
+        with open(path) as model_file:
+            model = json.load(model_file)
+        return DewarpModel(model['f'], model['O'], model['theta'], model['a_ms'],
+                           model['T'], model['boxes'], model['n_points_w'],
+                           family=surface_family(model['surface']),
+                           source_crop=model.get('source_crop'))
+
+    def surface(self):
+        return self.family.surface(self.a_ms, self.T)
+
+    # This model for the source scaled by k, e.g. 1 / s for a fit on the
+    # source resized by s. Pixel centers map as (x + 0.5) k - 0.5.
+    def scaled(self, k):
+        origin = self.O.copy()
+        source_crop = self.source_crop
+        if source_crop is not None:
+            origin += (source_crop.x0, source_crop.y0)
+            source_crop = Crop(*[int(round(c * k)) for c in source_crop])
+        O = (origin + 0.5) * k - 0.5
+        if source_crop is not None:
+            O -= (source_crop.x0, source_crop.y0)
+
+        family, a_ms = self.family.scaled(k, self.a_ms)
+        boxes = [Crop(*[c * k for c in box]) for box in self.boxes]
+        return DewarpModel(self.f * k, O, self.theta, a_ms, self.T * k, boxes,
+                           self.n_points_w * k, family=family,
+                           source_crop=source_crop)
+
+    def meshes(self, spec=None):
+        if spec is None:
+            spec = RenderSpec()
+
+        R, g = R_theta(self.theta), self.surface()
+        return [make_mesh_box(box_XY, self.O, R, g, self.n_points_w, scale=spec.scale,
+                              margin=spec.margin, focal_length=self.f)
+                for box_XY in self.boxes]
+
+    # page: the image the model was fitted on (source_crop already applied).
+    def render_page(self, page, spec=None):
+        if spec is None:
+            spec = RenderSpec()
+
+        page = binarize.grayscale(page) if spec.gray else page
+        return [correct_geometry(page, mesh, interpolation=cv2.INTER_LANCZOS4,
+                                 grid_step=spec.grid_step)
+                for mesh in self.meshes(spec)]
+
+    # source: the whole input image; renders this model's page of it.
+    def render(self, source, spec=None):
+        if self.source_crop is not None:
+            source = self.source_crop.apply(source)
+        return self.render_page(source, spec)
+
+ACCEPT_NORM = 120
+# Coarse-to-fine schedule: base points kept per line at each level (None =
+# all), each level starting from the previous solution. The last level is
+# still capped at MAX_RESIDUALS E_str points, bounding per-page cost.
+LEVELS = (8, None)
+MAX_RESIDUALS = 4000
+# LSMR needs tight tolerances; x_scale leaves the problem badly conditioned.
+TR_OPTIONS = {'atol': 1e-12, 'btol': 1e-12}
 class Kim2014(object):
-    def __init__(self, orig, im, lines, pages, O, AH, n_points_w):
+    def __init__(self, orig, im, lines, pages, O, AH, n_points_w, seed=0,
+                 sparse=True, rig=None, levels=LEVELS, max_residuals=MAX_RESIDUALS,
+                 source_crop=None, solver=SOLVER, deadline=None, max_nfev=None,
+                 surface=SURFACE, fit_scale=1., focal_length=None):
         self.orig = orig
         self.im = im
         self.lines = lines
@@ -1071,12 +2039,27 @@ class Kim2014(object):
         self.O = O
         self.AH = AH
         self.n_points_w = n_points_w
+        self.seed = seed
+        self.sparse = sparse  # sparse jacobians + LSMR trust-region solves
+        self.rig = rig  # RigProfile: lock theta, solve surface + lines only
+        self.source_crop = source_crop  # Crop of orig in the source image
+        self.solver = solver  # see SOLVER
+        self.deadline = deadline  # time.time() by which fitting must stop
+        self.max_nfev = max_nfev  # residual evaluations per optimizer run
+        self.fit_scale = fit_scale  # orig is the source resized by this
+        if focal_length is None:
+            focal_length = f if rig is None else rig.f
+        self.f = focal_length * fit_scale  # every projection reads this, not f
+        self.accept_norm = ACCEPT_NORM * fit_scale  # residuals are in orig pixels
+        self.stats = SolverStats()
+        self.debug_prefix = list(lib.current_debug_prefix())
+        self.opt_result = None
 
         for page in self.pages:
             page.sort(key=lambda l: l[0].y)
 
         # line points on focal plane
-        self.base_points = [line_base_points(line, O) for line in lines]
+        self.base_points = [line_base_points(line, O, self.f) for line in lines]
         # make underlines straight as well
         for line in lines:
             # if line.underlines: print('underlines:', len(line.underlines))
@@ -1087,19 +2070,60 @@ class Kim2014(object):
                 ])
                 mid_points = all_mid_points[:, :]
 
-                self.base_points.append(image_to_focal_plane(mid_points, O))
+                self.base_points.append(image_to_focal_plane(mid_points, O, self.f))
+
+        self.family = page_family(surface, self.base_points)
+
+        # RANSAC side inliers don't depend on the parameters; fix them once so
+        # every restart optimizes the same problem.
+        self.side_points = [page_side_points(page, AH, O, bw=im, focal_length=self.f)
+                            for page in self.pages]
+
+        # (projection, loss) per level of the coarse-to-fine schedule.
+        self.schedule = levels
+        self.max_residuals = max_residuals
+        self.levels = self.make_levels()
+
+    # Projections cache the last x and t0s, so concurrent runs each need
+    # their own levels.
+    def make_levels(self):
+        return [self.make_level(per_line, self.max_residuals) for per_line in self.schedule]
+
+    # All loss terms of a level read their projections from one shared
+    # context. per_line: base points kept per line (None = all).
+    def make_level(self, per_line, max_residuals):
+        base_points, point_weights = subsample_points(
+            self.base_points, per_set=per_line, max_points=max_residuals,
+        )
+        projection = Projection(len(self.pages), self.family, self.f)
+        loss = Projected(
+            E_str(base_points, projection, scale_t=True, sparse=self.sparse,
+                  point_weights=point_weights)
+            # + Regularize_T(base_points, projection) * 2.0,  # This just makes sure nothing crazy happens.
+            + make_E_align(self.side_points, len(self.base_points), projection,
+                           sparse=self.sparse) * 0.6,
+            projection,
+        )
+        return projection, loss
+
+    # warm: per-page (theta, a_m) from a neighbouring page; replaces the
+    # random theta_0 and flat surface.
+    def initial_args(self, seed=None, warm=None):
+        if warm is None and self.rig is not None and self.rig.a_m is not None:
+            warm = [(self.rig.theta, self.rig.a_m)]
+        if warm is not None and any(len(a_m) != self.family.n_params for _, a_m in warm):
+            warm = None  # fitted with another surface family
 
-    def initial_args(self):
         # Estimate viewpoint from vanishing point
-        vanishing_points = [estimate_vanishing(self.AH, page) \
+        vanishing_points = [estimate_vanishing(self.AH, page, bw=self.im) \
                             for page in self.pages]
         mean_image_vanishing = np.mean(vanishing_points, axis=0)
-        vanishing = np.concatenate([mean_image_vanishing - self.O, [-f]])
+        vanishing = np.concatenate([mean_image_vanishing - self.O, [-self.f]])
         vx, vy, _ = vanishing
         if lib.debug: print(' v:', vanishing)
 
-        xz_ratio = -f / vx  # theta_x / theta_z
-        norm_theta_sq = (atan2(np.sqrt(vx ** 2 + f ** 2), vy) - pi) ** 2
+        xz_ratio = -self.f / vx  # theta_x / theta_z
+        norm_theta_sq = (atan2(np.sqrt(vx ** 2 + self.f ** 2), vy) - pi) ** 2
         theta_z = np.sqrt(norm_theta_sq / (xz_ratio ** 2 + 1))
         theta_x = xz_ratio * theta_z
         theta_x
@@ -1109,15 +2133,25 @@ class Kim2014(object):
         # print('theta_0 dot ey:', theta_0.dot(np.array([0, 1, 0])))
         # print('theta_0 dot v:', theta_0.dot(vanishing))
         # theta_0 = np.array([0.1, 0, 0], dtype=np.float64)
-        theta_0 = (np.random.rand(3) - 0.5) / 4
+        if self.rig is not None:
+            theta_0 = self.rig.theta
+        elif warm is None:
+            theta_0 = (np.random.RandomState(seed).rand(3) - 0.5) / 4
+        else:
+            theta_0 = warm[0][0]
 
-        # flat surface as initial guess.
-        # NB: coeff 0 forced to 0 here. not included in opt.
-        a_m_0 = [0] * (DEGREE * len(self.pages))
+        if warm is None:
+            # flat surface as initial guess.
+            # NB: coeff 0 forced to 0 here. not included in opt.
+            a_m_0 = [0] * (self.family.n_params * len(self.pages))
+        else:
+            a_m_0 = np.concatenate([warm[min(i, len(warm) - 1)][1] \
+                                    for i in range(len(self.pages))])
 
         R_0 = R_theta(theta_0)
+        Of = np.array([0, 0, self.f], dtype=np.float64)
         _, ROf_y, ROf_z = R_0.dot(Of)
-        if lib.debug: print('Rv:', R_0.dot(np.array((vx, vy, -f))))
+        if lib.debug: print('Rv:', R_0.dot(np.array((vx, vy, -self.f))))
 
         all_surface = [R_0.dot(-points - Of[:, newaxis]) for points in self.base_points]
         l_m_0 = [Ys.mean() for _, Ys, _ in all_surface]
@@ -1133,30 +2167,105 @@ class Kim2014(object):
         return np.concatenate([theta_0, a_m_0, align_0, [T0], l_m_0])
 
     def run(self):
-        final_norm, opt_result = self.optimize()
-        return self.correct(opt_result)
-
-    def run_retry(self, n_tries=6):
+        final_norm, self.opt_result = self.optimize()
+        return self.correct(self.opt_result)
+
+    # Restart from theta_0 drawn with seeds self.seed, self.seed + 1, ... until
+    # one run reaches ACCEPT_NORM. A warm start, if given, is tried first. With
+    # processes > 1, that many runs go at once on threads (the solvers
+    # release the GIL; forking after OpenMP has run would hang); results are
+    # still taken in seed order, so the answer matches the serial one, and
+    # later runs are cancelled once an earlier one is accepted.
+    def run_retry(self, n_tries=6, processes=None, warm=None, spec=None):
+        return self.correct(self.fit(n_tries=n_tries, processes=processes,
+                                     warm=warm), spec=spec)
+
+    # The optimization half of run_retry; returns the best OptimizeResult.
+    def fit(self, n_tries=6, processes=None, warm=None):
+        if self.rig is not None:
+            n_tries = 1  # seeds only vary theta_0, which the rig fixes.
+
+        starts = [(self.seed + i, None) for i in range(n_tries)]
+        if warm is not None:
+            starts.insert(0, (self.seed, warm))
+
+        if processes is None or processes <= 1 or len(starts) == 1:
+            runs = (self.optimize(*start) for start in starts)
+            self.opt_result = self.best_run(self.record_runs(self.until_deadline(runs)))
+        else:
+            stop = threading.Event()
+            debug_prefix = lib.current_debug_prefix()
+
+            def restart(seed, warm):
+                if stop.is_set(): return None
+                try:
+                    with lib.thread_debug_prefix(debug_prefix):
+                        return self.optimize(seed, warm, levels=self.make_levels(),
+                                             stop=stop)
+                except RunCancelled:
+                    return None
+
+            pool = ThreadPool(min(processes, len(starts)))
+            try:
+                pending = [pool.apply_async(restart, start) for start in starts]
+                runs = self.until_deadline(p.get() for p in pending)
+                self.opt_result = self.best_run(self.record_runs(runs))
+            finally:
+                stop.set()
+                pool.close()
+                pool.join()
+
+        if self.opt_result is None:
+            raise DeadlineExceeded('no optimizer run finished before the deadline')
+
+        return self.opt_result
+
+    def record_runs(self, runs):
+        for final_norm, opt_result in runs:
+            self.stats.add_run(final_norm, opt_result)
+            yield final_norm, opt_result
+
+    # runs, cut off at the first one stopped by the deadline; no run starts
+    # after it has passed.
+    def until_deadline(self, runs):
+        try:
+            for run in runs:
+                yield run
+                if self.deadline is not None and time.time() > self.deadline:
+                    print('**** DEADLINE PASSED. ****')
+                    return
+        except DeadlineExceeded:
+            print('**** DEADLINE EXCEEDED. ****')
+
+    # per-page (theta, a_m) of an accepted run, for BookParams; else None.
+    def converged(self):
+        if self.opt_result is None or norm(self.opt_result.fun) >= self.accept_norm:
+            return None
+
+        theta, a_ms, _, _, _, _ = unpack_args(self.opt_result.x, len(self.pages),
+                                              self.family)
+        return [(theta, a_m) for a_m in a_ms]
+
+    def best_run(self, runs):
         best_result = None
         best_norm = np.inf
-        for _ in range(n_tries):
-            final_norm, opt_result = self.optimize()
+        for final_norm, opt_result in runs:
             if final_norm < best_norm:
                 best_norm = final_norm
                 best_result = opt_result
 
-            if final_norm < 120:
+            if final_norm < self.accept_norm:
                 break
             else:
                 print("**** BAD RUN. ****")
 
-        return self.correct(best_result)
+        return best_result
 
     def debug_images(self, R, g, align, l_m):
         if not lib.debug: return
 
         debug = cv2.cvtColor(self.im, cv2.COLOR_GRAY2BGR)
-        ts_surface = E_str_project(R, g, self.base_points, 0)
+        ts_surface = E_str_project(R, g, self.base_points, self.f)
 
         # debug_jac(theta, R, g, l_m, base_points, ts_surface)
 
@@ -1168,7 +2277,7 @@ class Kim2014(object):
             line_Ys = np.full((100,), Y)
             line_Zs = g(line_Xs)
             line_XYZ = np.stack([line_Xs, line_Ys, line_Zs])
-            line_2d = gcs_to_image(line_XYZ, self.O, R).T
+            line_2d = gcs_to_image(line_XYZ, self.O, R, self.f).T
             for p0, p1 in zip(line_2d, line_2d[1:]):
                 draw_line(debug, p0, p1, GREEN, 1)
 
@@ -1177,7 +2286,7 @@ class Kim2014(object):
             line_Ys = np.array([-10000, 10000])
             line_Zs = g(line_Xs)
             line_XYZ = np.stack([line_Xs, line_Ys, line_Zs])
-            line_2d = gcs_to_image(line_XYZ, self.O, R).T
+            line_2d = gcs_to_image(line_XYZ, self.O, R, self.f).T
             for p0, p1 in zip(line_2d, line_2d[1:]):
                 draw_line(debug, p0, p1, RED, 4)
 
@@ -1186,46 +2295,104 @@ class Kim2014(object):
             line_Ys = np.array([-10000, 10000])
             line_Zs = g(line_Xs)
             line_XYZ = np.stack([line_Xs, line_Ys, line_Zs])
-            line_2d = gcs_to_image(line_XYZ, self.O, R).T
+            line_2d = gcs_to_image(line_XYZ, self.O, R, self.f).T
             draw_line(debug, line_2d[0], line_2d[1], BLUE, 4)
 
         lib.debug_imwrite('surface_lines.png', debug)
 
-    def optimize(self):
-        global E_str_t0s, E_align_t0s
-        E_str_t0s, E_align_t0s = [], []
-
+    # levels: this run's (projection, loss) levels (default self.levels);
+    # stop: threading.Event that cancels the run (RunCancelled).
+    def optimize(self, seed=None, warm=None, levels=None, stop=None):
+        start = time.time()
         n_pages = len(self.pages)
-        args_0 = self.initial_args()
+        seed = self.seed if seed is None else seed
+        args_0 = self.initial_args(seed=seed, warm=warm)
 
         x_scale = np.concatenate([
             [0.3] * 3,
-            np.tile(1000 * ((3e-4 / OMEGA) ** np.arange(DEGREE)), n_pages),
+            np.tile(self.family.x_scale(), n_pages),
             [1000, 1000] * n_pages,
             [1000],
             [1000] * len(self.base_points),
         ])
 
-        loss = DebugLoss(
-            Preproject(E_str(self.base_points, n_pages, scale_t=True),
-                        # + Regularize_T(self.base_points, n_pages) * 2.0,  # This just makes sure nothing crazy happens.
-                        self.base_points, n_pages) \
-            + make_E_align(self.pages, self.AH, self.O) * 0.6
-        )
-
-        # result = lm(
-        result = opt.least_squares(
-            fun=loss.residuals,
-            x0=args_0,
-            jac=loss.jac,
-            # method='lm',
-            ftol=1e-3,
-            # max_nfev=1,
-            # x_scale='jac',
-            x_scale=x_scale,
-        )
-
-        theta, a_ms, align, T, l_m, g = unpack_args(result.x, n_pages)
+        free = np.ones(args_0.shape, dtype=bool)
+        if self.rig is not None:
+            free[:3] = False  # theta
+
+        if levels is None:
+            levels = self.levels
+
+        x = args_0
+        result = None
+        skipped_levels = 0
+        total_nfev, total_njev = 0, 0
+        newton_stats = np.zeros(newton.STATS_LEN, dtype=np.int64)
+        for i, (projection, loss) in enumerate(levels):
+            budget = {}
+            if self.max_nfev is not None:
+                if total_nfev >= self.max_nfev:
+                    skipped_levels = len(levels) - i
+                    break
+                budget['max_nfev'] = self.max_nfev - total_nfev
+
+            projection.reset()
+            projection.stats = newton_stats
+            fixed = Fixed(loss, x, free)
+            debug_loss = DebugLoss(fixed)
+            if self.deadline is not None or stop is not None:
+                debug_loss = Deadline(debug_loss, self.deadline, stop)
+
+            if self.solver == 'lm':
+                result = lm(
+                    fun=debug_loss.residuals,
+                    x0=x[free],
+                    jac=debug_loss.jac,
+                    ftol=1e-3,
+                    x_scale=x_scale[free],
+                    geodesic_accel=True,
+                    n_block=len(self.base_points),  # l_m are the last parameters
+                    **budget
+                )
+            else:
+                result = opt.least_squares(
+                    fun=debug_loss.residuals,
+                    x0=x[free],
+                    jac=debug_loss.jac,
+                    # method='lm',
+                    ftol=1e-3,
+                    # max_nfev=1,
+                    # x_scale='jac',
+                    x_scale=x_scale[free],
+                    tr_solver='lsmr' if self.sparse else 'exact',
+                    tr_options=TR_OPTIONS if self.sparse else {},
+                    **budget
+                )
+            x = result.x = fixed.full(result.x)
+            total_nfev += result.nfev
+            total_njev += result.njev
+            if lib.debug: print('level norm:', norm(result.fun), 'nfev:', result.nfev)
+
+        # Budget spent before the full-resolution level: score x on it anyway,
+        # so final norms (and ACCEPT_NORM) always refer to the full problem.
+        if skipped_levels:
+            print('max_nfev spent; skipped {} level(s).'.format(skipped_levels))
+            projection, loss = levels[-1]
+            projection.reset()
+            projection.stats = newton_stats
+            fun = loss.residuals(x)
+            if result is None:
+                result = opt.OptimizeResult(x=x, status=0, success=False,
+                                            message='max_nfev spent before any level')
+            result.fun = fun
+
+        result.skipped_levels = skipped_levels
+        result.nfev, result.njev = total_nfev, total_njev
+        result.newton_stats = newton_stats
+        result.seed, result.warm = seed, warm is not None
+        result.seconds = time.time() - start
+
+        theta, a_ms, align, T, l_m, g = unpack_args(result.x, n_pages, self.family)
         final_norm = norm(result.fun)
 
         print('*** OPTIMIZATION DONE ***')
@@ -1240,20 +2407,24 @@ class Kim2014(object):
 
         return final_norm, result
 
-    def correct(self, opt_result):
-        theta, a_ms, align, T, l_m, g = unpack_args(opt_result.x, len(self.pages))
+    def model(self, opt_result):
+        theta, a_ms, align, T, l_m, g = unpack_args(opt_result.x, len(self.pages),
+                                                    self.family)
 
         R = R_theta(theta)
 
         self.debug_images(R, g, align, l_m)
 
-        mesh_2ds = make_mesh_2d(self.lines, self.O, R, g, n_points_w=self.n_points_w)
-        result = []
-        for mesh_2d in mesh_2ds:
-            first_pass = correct_geometry(self.orig, mesh_2d, interpolation=cv2.INTER_LANCZOS4)
-            result.append(first_pass)
+        boxes = surface_boxes(self.lines, self.O, R, g, bw=self.im, focal_length=self.f)
+        n_points_w = self.n_points_w
+        if n_points_w is None:
+            n_points_w = default_mesh_width(self.lines, self.fit_scale)
 
-        return result
+        return DewarpModel(self.f, self.O, theta, a_ms, T, boxes, n_points_w,
+                           family=self.family, source_crop=self.source_crop)
+
+    def correct(self, opt_result, spec=None):
+        return self.model(opt_result).render_page(self.orig, spec)
 
 def go(argv):
     im = cv2.imread(argv[1], cv2.IMREAD_UNCHANGED)
@@ -4,7 +4,6 @@ import cv2
 import numpy as np
 
 from numpy.polynomial.polynomial import Polynomial as P
-from functools import reduce
 
 BLUE = (255, 0, 0)
 
@@ -14,6 +13,48 @@ def closest_root_to(poly_on, poly_root, p):
     good_roots_points = np.vstack([good_roots, poly_on(good_roots)]).T
     return good_roots_points[abs(good_roots_points - p).sum(axis=1).argmin()]
 
+def poly_coef(poly):
+    coef = poly.convert().coef if isinstance(poly, P) else np.asarray(poly)
+    return np.asarray(coef, dtype=np.float64)
+
+# roots of p_k(x) - (m_k x + b_k) for K polynomials/lines at once.
+# coefs: (K, n + 1) or (n + 1,); returns (K, n) complex (nan if degenerate).
+def poly_line_roots(coefs, ms, bs):
+    ms, bs = np.broadcast_arrays(np.atleast_1d(ms), np.atleast_1d(bs))
+    coefs = np.atleast_2d(coefs)
+    n = max(coefs.shape[1] - 1, 1)
+    padded = np.zeros((ms.shape[0], n + 1), dtype=np.float64)
+    padded[:, :coefs.shape[1]] = coefs
+    padded[:, 0] -= bs
+    padded[:, 1] -= ms
+
+    lead = padded[:, -1]
+    degenerate = lead == 0
+    lead = np.where(degenerate, 1., lead)
+
+    # companion matrix: ones on subdiagonal, -c_i / c_n in last column.
+    companion = np.zeros((ms.shape[0], n, n), dtype=np.float64)
+    companion[:, np.arange(1, n), np.arange(n - 1)] = 1
+    companion[:, :, -1] = -padded[:, :-1] / lead[:, np.newaxis]
+    roots = np.linalg.eigvals(companion).astype(np.complex128)
+    roots[degenerate] = np.nan
+    return roots
+
+# batched closest_root_to: for each k, real root of roots[k] whose point on
+# poly_on (coefs[k]) is closest to ps[k] (L1).
+def closest_roots_to(coefs, roots, ps):
+    coefs = np.atleast_2d(coefs)
+    real = np.abs(roots.imag) < 1e-10
+    xs = np.where(real, roots.real, 0.)
+    ys = np.polynomial.polynomial.polyval(xs.T, coefs.T, tensor=False).T
+    dists = np.abs(xs - ps[:, 0:1]) + np.abs(ys - ps[:, 1:2])
+    dists[~real] = np.inf
+    best = dists.argmin(axis=1)
+    idx = np.arange(xs.shape[0])
+    result = np.stack([xs[idx, best], ys[idx, best]], axis=1)
+    result[~real.any(axis=1)] = np.nan
+    return result
+
 class Line(object):
     def __init__(self, m, b):
         self.m = m
@@ -98,15 +139,7 @@ class Line(object):
 
     @staticmethod
     def best_intersection(lines):
-        bases = [l.base() for l in lines]
-        vecs = [l.vector() for l in lines]
-        K = len(lines)
-        I = np.eye(2)
-        R = K * I - sum((np.outer(v, v.T) for v in vecs))
-        q = sum(bases) - sum((v * v.dot(a)) for v, a in zip(vecs, bases))
-        R_inv = np.linalg.pinv(R)
-        p = np.dot(R_inv, q)
-        return p
+        return LineArray.from_lines(lines).best_intersection()
 
     def __str__(self):
         return 'Line[y = {:.2f}x + {:.2f}]'.format(self.m, self.b)
@@ -114,6 +147,103 @@ class Line(object):
     def __repr__(self):
         return 'Line({}, {})'.format(self.m, self.b)
 
+# K lines y = m_k x + b_k, with the operations of Line applied elementwise.
+class LineArray(object):
+    def __init__(self, m, b):
+        self.m, self.b = np.broadcast_arrays(
+            np.atleast_1d(np.asarray(m, dtype=np.float64)),
+            np.atleast_1d(np.asarray(b, dtype=np.float64)),
+        )
+
+    def __call__(self, x):
+        return self.m * x + self.b
+
+    def __len__(self):
+        return self.m.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) or not np.isscalar(key):
+            return LineArray(self.m[key], self.b[key])
+        return Line(self.m[key], self.b[key])
+
+    def __iter__(self):
+        return (Line(m, b) for m, b in zip(self.m, self.b))
+
+    @staticmethod
+    def from_lines(lines):
+        lines = list(lines)
+        return LineArray([l.m for l in lines], [l.b for l in lines])
+
+    # p0: (K, 2) or (2,) points; m: K or scalar slopes.
+    @staticmethod
+    def from_point_slope(p0, m):
+        p0 = np.asarray(p0, dtype=np.float64)
+        x0, y0 = p0[..., 0], p0[..., 1]
+        return LineArray(m, y0 - m * x0)
+
+    @staticmethod
+    def from_points(p0, p1):
+        p0 = np.asarray(p0, dtype=np.float64)
+        p1 = np.asarray(p1, dtype=np.float64)
+        d = p1 - p0
+        m = d[..., 1] / d[..., 0]
+        return LineArray.from_point_slope(p0, m)
+
+    def intersect(self, other):
+        x = (other.b - self.b) / (self.m - other.m)
+        return np.stack(np.broadcast_arrays(x, self(x)), axis=-1)
+
+    def closest_point(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        px, py = points[..., 0], points[..., 1]
+        x = (px + self.m * (py - self.b)) / (1 + self.m * self.m)
+        return np.stack([x, self(x)], axis=-1)
+
+    def distance_point(self, points):
+        return np.linalg.norm(self.closest_point(points) - points, axis=-1)
+
+    def base(self):
+        return np.stack([np.zeros_like(self.b), self.b], axis=-1)
+
+    def vector(self):
+        vecs = np.stack([np.ones_like(self.m), self.m], axis=-1)
+        return vecs / np.linalg.norm(vecs, axis=-1)[:, np.newaxis]
+
+    def angle(self):
+        return np.arctan(self.m)
+
+    def offset(self, offset):
+        return LineArray.from_point_slope(self.base() + offset, self.m)
+
+    # poly: one Polynomial or a list, one per line. p: (K, 2) approx points.
+    def closest_poly_intersect(self, poly, p):
+        if isinstance(poly, P):
+            coefs = poly_coef(poly)
+        else:
+            coefs = np.array([poly_coef(q) for q in poly])
+        roots = poly_line_roots(coefs, self.m, self.b)
+        p = np.broadcast_to(p, roots.shape[:1] + (2,))
+        return closest_roots_to(coefs, roots, p)
+
+    # text_line: one TextLine, or a list of them (one per line).
+    def text_line_intersect(self, text_line):
+        if isinstance(text_line, (list, tuple)):
+            approx = LineArray.from_lines([tl.approx_line() for tl in text_line])
+            polys = [tl.model for tl in text_line]
+        else:
+            approx = text_line.approx_line()
+            polys = text_line.model
+        return self.closest_poly_intersect(polys, self.intersect(approx))
+
+    # least-squares point closest to all lines.
+    def best_intersection(self):
+        bases = self.base()
+        vecs = self.vector()
+        K = len(self)
+        R = K * np.eye(2) - vecs.T.dot(vecs)
+        q = bases.sum(axis=0) - (vecs * (vecs * bases).sum(axis=1)[:, np.newaxis]).sum(axis=0)
+        return np.dot(np.linalg.pinv(R), q)
+
 class Line3D(object):
     # p0, p1: points on line
     def __init__(self, p0, p1):
@@ -161,16 +291,7 @@ class Crop(object):
 
     @staticmethod
     def from_line(line):
-        result = Crop(
-            min([letter.left() for letter in line]),
-            min([letter.top() for letter in line]),
-            max([letter.right() for letter in line]),
-            max([letter.bottom() for letter in line])
-        )
-        if line.underlines:
-            result = result.union(Crop.union_all((under.crop() for under in line.underlines)))
-
-        return result
+        return line.crop()
 
     @staticmethod
     def from_lines(lines):
@@ -205,7 +326,7 @@ class Crop(object):
 
     @staticmethod
     def intersect_all(crops):
-        return reduce(Crop.intersect, crops)
+        return CropArray.from_crops(crops).intersect_all()
 
     def union(self, other):
         return Crop(
@@ -217,7 +338,7 @@ class Crop(object):
 
     @staticmethod
     def union_all(crops):
-        return reduce(Crop.union, crops)
+        return CropArray.from_crops(crops).union_all()
 
     def apply(self, im):
         assert self.nonempty()
@@ -274,3 +395,69 @@ class Crop(object):
 
     def __iter__(self):
         return iter((self.x0, self.y0, self.x1, self.y1))
+
+# N crops as an (N, 4) array of (x0, y0, x1, y1).
+class CropArray(object):
+    def __init__(self, coords):
+        self.coords = np.asarray(coords).reshape(-1, 4)
+
+    @staticmethod
+    def from_crops(crops):
+        return CropArray([tuple(c) for c in crops])
+
+    @property
+    def x0(self): return self.coords[:, 0]
+
+    @property
+    def y0(self): return self.coords[:, 1]
+
+    @property
+    def x1(self): return self.coords[:, 2]
+
+    @property
+    def y1(self): return self.coords[:, 3]
+
+    @property
+    def w(self): return self.x1 - self.x0
+
+    @property
+    def h(self): return self.y1 - self.y0
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) or not np.isscalar(key):
+            return CropArray(self.coords[key])
+        return Crop(*self.coords[key])
+
+    def __iter__(self):
+        return (Crop(*c) for c in self.coords)
+
+    def nonempty(self):
+        return (self.x0 < self.x1) & (self.y0 < self.y1)
+
+    def intersect(self, other):
+        return CropArray(np.concatenate([
+            np.maximum(self.coords[:, :2], (other.x0, other.y0)),
+            np.minimum(self.coords[:, 2:], (other.x1, other.y1)),
+        ], axis=1))
+
+    def intersect_all(self):
+        return Crop(*np.concatenate([self.coords[:, :2].max(axis=0),
+                                     self.coords[:, 2:].min(axis=0)]))
+
+    def union_all(self):
+        return Crop(*np.concatenate([self.coords[:, :2].min(axis=0),
+                                     self.coords[:, 2:].max(axis=0)]))
+
+    def apply(self, im):
+        clipped = self.intersect(Crop.full(im)).coords.astype(int)
+        return [im[y0:y1, x0:x1] for x0, y0, x1, y1 in clipped]
+
+    # distance from point (x, y) to each crop; 0 if inside.
+    def distance_point(self, point):
+        x, y = point
+        dx = np.maximum(np.maximum(self.x0 - x, 0), x - self.x1)
+        dy = np.maximum(np.maximum(self.y0 - y, 0), y - self.y1)
+        return np.hypot(dx, dy)
@@ -108,6 +108,13 @@ class TextLine(object):
         self._inliers = None
         self._line_inliers = None
         self.underlines = underlines if underlines is not None else []
+        self.invalidate()
+
+    def invalidate(self):
+        # drop cached geometry; call whenever letters or underlines change.
+        self._table = None
+        self._base_points = None
+        self._crop = None
 
     def __iter__(self):
         return (l for l in self.letters)
@@ -134,6 +141,7 @@ class TextLine(object):
     def compress(self, flags):
         assert len(flags) == len(self.letters)
         self.letters = list(itertools.compress(self.letters, flags))
+        self.invalidate()
 
     def merge(self, other):
         self.letters += other.letters
@@ -144,6 +152,11 @@ class TextLine(object):
         self._inliers = None
         self.model_line = None
         self._line_inliers = None
+        self.invalidate()
+
+    def add_underline(self, underline):
+        self.underlines.append(underline)
+        self._crop = None
 
     def domain(self):
         return self.letters[0].base_point()[0], self.letters[-1].base_point()[0]
@@ -172,17 +185,32 @@ class TextLine(object):
     def approx_line(self):
         return Line.from_points(self.first_base(), self.last_base())
 
+    # (N, 4) table of (x, y, w, h) for current letters.
+    def table(self):
+        if self._table is None:
+            table = np.array([l.tuple() for l in self.letters], dtype=np.int64)
+            self._table = table.reshape(-1, 4)
+            self._table.flags.writeable = False
+
+        return self._table
+
     def base_points(self):
-        return np.array([l.base_point() for l in self.letters])
+        if self._base_points is None:
+            x, y, w, h = self.table().T
+            self._base_points = np.stack([x + w / 2.0, (y + h).astype(np.float64)], axis=1)
+            self._base_points.flags.writeable = False
+
+        return self._base_points
 
     def crop(self):
-        if self.underlines:
-            return Crop.union(
-                Crop.union_all([l.crop() for l in self.letters]),
-                Crop.union_all([u.crop() for u in self.underlines]),
-            )
-        else:
-            return Crop.union_all([l.crop() for l in self.letters])
+        if self._crop is None:
+            x, y, w, h = self.table().T
+            result = Crop(x.min(), y.min(), (x + w).max(), (y + h).max())
+            if self.underlines:
+                result = result.union(Crop.union_all([u.crop() for u in self.underlines]))
+            self._crop = result
+
+        return self._crop
 
     class PolyModel5(object):
         def estimate(self, data):
@@ -5,7 +5,9 @@ import numpy as np
 import os
 import os.path
 import rawpy
+import threading
 import time
+from contextlib import contextmanager
 
 BLUE = (255, 0, 0)
 GREEN = (0, 255, 0)
@@ -13,13 +15,38 @@ RED = (0, 0, 255)
 
 debug = False
 debug_prefix = []
+thread_state = threading.local()
+
+# Debug output directory components for this thread: those of the innermost
+# thread_debug_prefix block, else the shared debug_prefix.
+def current_debug_prefix():
+    return getattr(thread_state, 'debug_prefix', debug_prefix)
+
+# Send this thread's debug output under prefix (a list of directory
+# components) within the block, leaving the shared debug_prefix alone.
+@contextmanager
+def thread_debug_prefix(prefix):
+    outer = getattr(thread_state, 'debug_prefix', None)
+    thread_state.debug_prefix = list(prefix)
+    try:
+        yield
+    finally:
+        if outer is None:
+            del thread_state.debug_prefix
+        else:
+            thread_state.debug_prefix = outer
+
 def debug_imwrite(filename, im):
     if not debug: return False
 
-    if debug_prefix:
-        directory = os.path.join(*debug_prefix)
+    prefix = current_debug_prefix()
+    if prefix:
+        directory = os.path.join(*prefix)
         if not os.path.isdir(directory):
-            os.makedirs(directory)
+            try:
+                os.makedirs(directory)
+            except OSError:  # another thread got there first
+                if not os.path.isdir(directory): raise
     else:
         directory = '.'
 
@@ -1,9 +1,11 @@
 import cv2
 import numpy as np
+from scipy import interpolate
 
+from algorithm import FINE_DEWARP_MAX
 from dewarp import get_AH_lines, correct_geometry, estimate_vanishing, \
     arc_length_points
-from geometry import Line
+from geometry import Line, LineArray
 import lib
 from lib import RED, GREEN, BLUE
 
@@ -56,10 +58,11 @@ def C0_C1(lines, v):
 def widest_domain(lines, v, n_points):
     C0, C1 = C0_C1(lines, v)
 
-    v_lefts = [Line.from_points(v, l[0].left_bot()) for l in lines if l is not C0]
-    v_rights = [Line.from_points(v, l[-1].right_bot()) for l in lines if l is not C0]
-    C0_lefts = [l.text_line_intersect(C0)[0] for l in v_lefts]
-    C0_rights = [l.text_line_intersect(C0)[0] for l in v_rights]
+    others = [l for l in lines if l is not C0]
+    v_lefts = LineArray.from_points(v, [l[0].left_bot() for l in others])
+    v_rights = LineArray.from_points(v, [l[-1].right_bot() for l in others])
+    C0_lefts = v_lefts.text_line_intersect(C0)[:, 0]
+    C0_rights = v_rights.text_line_intersect(C0)[:, 0]
 
     x_min = min(C0.left(), min(C0_lefts))
     x_max = max(C0.left(), max(C0_rights))
@@ -83,9 +86,8 @@ def estimate_directrix(lines, v, n_points_w):
     domain, C0, C1 = widest_domain(lines, v, N_POINTS)
 
     C0_points = np.vstack([domain, C0(domain)])
-    longitudes = [Line.from_points(v, p) for p in C0_points.T]
-    C1_points = np.array([l.closest_poly_intersect(C1.model, p) \
-                          for l, p in zip(longitudes, C0_points.T)]).T
+    longitudes = LineArray.from_points(v, C0_points.T)
+    C1_points = longitudes.closest_poly_intersect(C1.model, C0_points.T).T
     lambdas = (vy - C0_points[1]) / (C1_points[1] - C0_points[1])
     alphas = MU * lambdas / (MU + lambdas - 1)
     C_points = (1 - alphas) * C0_points + alphas * C1_points
@@ -185,9 +187,9 @@ def necessary_mu(C0, C1, v, all_lines, mode):
         global mu_debug
         cv2.circle(mu_debug, tuple(p.astype(int)), 6, GREEN, -1)
 
-    longitudes = [Line.from_points(v, p) for p in points]
-    C0_points = np.array([l.text_line_intersect(C0) for l in longitudes]).T
-    C1_points = np.array([l.text_line_intersect(C1) for l in longitudes]).T
+    longitudes = LineArray.from_points(v, points)
+    C0_points = longitudes.text_line_intersect(C0).T
+    C1_points = longitudes.text_line_intersect(C1).T
     lambdas = (vy - C0_points[1]) / (C1_points[1] - C0_points[1])
     alphas = (points[:, 1] - C0_points[1]) / (C1_points[1] - C0_points[1])
     mus = alphas * (1 - lambdas) / (alphas - lambdas)
@@ -208,17 +210,14 @@ def generate_mesh(all_lines, lines, C_arc, v, n_points_h):
     mu_top = necessary_mu(C0, C1, v, all_lines, MuMode.TOP)
     lib.debug_imwrite('mu.png', mu_debug)
 
-    longitude_lines = [Line.from_points(v, p) for p in C_arc_T]
-    longitudes = []
+    longitude_lines = LineArray.from_points(v, C_arc_T)
     mus = np.linspace(mu_top, mu_bottom, n_points_h)
-    for l, C_i in zip(longitude_lines, C_arc_T):
-        p0 = l.closest_poly_intersect(C0.model, C_i)
-        p1 = l.closest_poly_intersect(C1.model, C_i)
-        lam = (vy - p0[1]) / (p1[1] - p0[1])
-        alphas = mus * lam / (mus + lam - 1)
-        longitudes.append(np.outer(1 - alphas, p0) + np.outer(alphas, p1))
-
-    result = np.array(longitudes)
+    p0 = longitude_lines.closest_poly_intersect(C0.model, C_arc_T)
+    p1 = longitude_lines.closest_poly_intersect(C1.model, C_arc_T)
+    lam = ((vy - p0[:, 1]) / (p1[:, 1] - p0[:, 1]))[:, np.newaxis]
+    alphas = (mus * lam / (mus + lam - 1))[:, :, np.newaxis]
+    # longitudes x mus x 2
+    result = (1 - alphas) * p0[:, np.newaxis] + alphas * p1[:, np.newaxis]
 
     debug = cv2.cvtColor(bw, cv2.COLOR_GRAY2BGR)
     for l in result[::50]:
@@ -228,7 +227,7 @@ def generate_mesh(all_lines, lines, C_arc, v, n_points_h):
     trace_baseline(debug, C1, RED)
     lib.debug_imwrite('mesh.png', debug)
 
-    return np.array(longitudes).transpose(1, 0, 2)
+    return result.transpose(1, 0, 2)
 
 def spline_model(line):
     base_points = np.array([letter.base_point() for letter in line])
@@ -266,6 +265,7 @@ def min_crop(lines):
     lib.debug_imwrite('crop.png', debug)
     return box
 
+# im: bw page, black text on white.
 @lib.timeit
 def dewarp_fine(im):
     lib.debug_prefix = 'fine_'
@@ -287,46 +287,40 @@ def dewarp_fine(im):
     # grid_x, grid_y = np.mgrid[:im_h, :im_w]
     # y_offset_interp = interpolate.griddata(points, offsets,
     #                                        (grid_x, grid_y), method='nearest')
+    # Offsets past FINE_DEWARP_MAX are misread baselines, and without an
+    # explicit s the spline interpolates them into huge swings between lines.
     y_offset_interp = interpolate.SmoothBivariateSpline(
-        points[:, 0], points[:, 1], offsets
+        points[:, 0], points[:, 1], offsets.clip(-FINE_DEWARP_MAX, FINE_DEWARP_MAX),
+        s=points.shape[0]
     )
 
-    new = np.full(im.shape, 0, dtype=np.uint8)
-    _, contours, [hierarchy] = \
-        cv2.findContours(im, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    draw_contours(new, contours, hierarchy, y_offset_interp, 0, 255)
+    # Move each letter (4-connected black component, holes included) so its
+    # bottom center lands on its line.
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(im ^ 255, connectivity=4)
+    xs, ys, ws, hs = stats[:, :4].T
+    shifts = y_offset_interp(xs + ws / 2.0, ys + hs, grid=False)
+    shifts = np.round(shifts.clip(-FINE_DEWARP_MAX, FINE_DEWARP_MAX)).astype(int)
+    shifts[0] = 0  # background
 
-    lib.debug_imwrite('fine.png', new)
+    rows, cols = np.nonzero(labels)
+    new_rows = rows + shifts[labels[rows, cols]]
+    inside = (new_rows >= 0) & (new_rows < im_h)
 
-    return new
+    new = np.full(im.shape, 255, dtype=np.uint8)
+    new[new_rows[inside], cols[inside]] = 0
 
-def draw_contours(im, contours, hierarchy, y_offset_interp, idx, color,
-                  depth=0, passed_offset=None):
-    while idx >= 0:
-        x, y, w, h = cv2.boundingRect(contours[idx])
-        # print '+' * depth, idx, 'color:', color, '@', x, y, 'offset:', offset, 'area:', w * h
-        if passed_offset is None:
-            offset = (0, -int(round(y_offset_interp(x + w / 2.0, y + h))))
-            # offset = (0, -int(round(y_offset_interp[y + h - 1, x + w / 2 - 1])))
-        else:
-            offset = passed_offset
+    lib.debug_imwrite('fine.png', new)
 
-        cv2.drawContours(im, contours, idx, color, thickness=cv2.FILLED,
-                         offset=offset)
-        child = hierarchy[idx][2]
-        if child >= 0:
-            pass_offset = offset if color == 0 and w * h < 5000 else None
-            draw_contours(im, contours, hierarchy, y_offset_interp, child,
-                          255 - color, depth=depth + 1, passed_offset=pass_offset)
-        idx = hierarchy[idx][0]
+    return new
 
 def full_lines(AH, lines, v):
     C0 = max(lines, key=lambda l: l.right() - l.left())
 
-    v_lefts = [Line.from_points(v, l[0].left_bot()) for l in lines if l is not C0]
-    v_rights = [Line.from_points(v, l[-1].right_bot()) for l in lines if l is not C0]
-    C0_lefts = [l.text_line_intersect(C0)[0] for l in v_lefts]
-    C0_rights = [l.text_line_intersect(C0)[0] for l in v_rights]
+    others = [l for l in lines if l is not C0]
+    v_lefts = LineArray.from_points(v, [l[0].left_bot() for l in others])
+    v_rights = LineArray.from_points(v, [l[-1].right_bot() for l in others])
+    C0_lefts = v_lefts.text_line_intersect(C0)[:, 0]
+    C0_rights = v_rights.text_line_intersect(C0)[:, 0]
 
     mask = np.logical_and(C0_lefts <= C0.left() + AH, C0_rights >= C0.right() - AH)
     return compress(lines, mask)
@@ -338,23 +332,31 @@ def vanishing_point(lines, v0, O):
 
     domain = np.linspace(C0.left(), C0.right(), N_LONGS + 2)[1:-1]
     C0_points = np.array([domain, C0.model(domain)]).T
-    longitudes = [Line.from_points(v0, p) for p in C0_points]
+    longitudes = LineArray.from_points(v0, C0_points)
 
-    lefts = [longitudes[0].text_line_intersect(line)[0] for line in others]
-    rights = [longitudes[-1].text_line_intersect(line)[0] for line in others]
+    n_others = len(others)
+    lefts = LineArray(longitudes.m[0], longitudes.b[0]).text_line_intersect(others)[:, 0]
+    rights = LineArray(longitudes.m[-1], longitudes.b[-1]).text_line_intersect(others)[:, 0]
     valid_mask = [line.left() <= L and R < line.right() \
                    for line, L, R in zip(others, lefts, rights)]
 
     valid_lines = [C0] + compress(others, valid_mask)
     derivs = [line.model.deriv() for line in valid_lines]
-    print('valid lines:', len(others))
-
-    convergences = []
-    for longitude in longitudes:
-        intersects = [longitude.text_line_intersect(line) for line in valid_lines]
-        tangents = [Line.from_point_slope(p, d(p[0])) \
-                    for p, d in zip(intersects, derivs)]
-        convergences.append(Line.best_intersection(tangents))
+    print('valid lines:', n_others)
+
+    # all (longitude, line) pairs at once, longitude-major.
+    n_valid = len(valid_lines)
+    pairs = LineArray(np.repeat(longitudes.m, n_valid),
+                      np.repeat(longitudes.b, n_valid))
+    intersects = pairs.text_line_intersect(valid_lines * len(longitudes))
+    slopes = np.empty(len(pairs))
+    for j, d in enumerate(derivs):
+        slopes[j::n_valid] = d(intersects[j::n_valid, 0])
+    all_tangents = LineArray.from_point_slope(intersects, slopes)
+
+    convergences = [all_tangents[i:i + n_valid].best_intersection()
+                    for i in range(0, len(pairs), n_valid)]
+    tangents = all_tangents[-n_valid:]
 
     # x vx + y vy + f^2 = 0
     # m = -vx / vy
@@ -0,0 +1,52 @@
+from __future__ import division, print_function
+
+import argparse
+import cv2
+import numpy as np
+
+import dewarp
+import lib
+
+# Re-render pages from saved dewarp models (batch.py --save-models) at a new
+# resolution or margin, without re-optimizing.
+def render(source, model_paths, spec=None):
+    images = []
+    for path in model_paths:
+        images.extend(dewarp.DewarpModel.load(path).render(source, spec))
+    return images
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render pages from saved dewarp models.')
+    parser.add_argument('image', help='Source image the models were fitted on.')
+    parser.add_argument('models', nargs='+', help='Model files (JSON).')
+    parser.add_argument('-o', '--output', action='store', default='rendered',
+                        help='Output prefix; pages are written as <prefix><n>.png.')
+    parser.add_argument('-d', '--dpi', action='store', type=int,
+                        help='Output DPI (source DPI is detected as in batch.py).')
+    parser.add_argument('--scale', action='store', type=float,
+                        help='Output pixels per source pixel; overrides --dpi.')
+    parser.add_argument('--margin', action='store', type=float, default=0.01,
+                        help='Fraction of the text box kept around it.')
+    parser.add_argument('--gray', action='store_true', help='Render one channel.')
+    parser.add_argument('--grid-step', action='store', type=int,
+                        help='Interpolate remaps from a control grid this many '
+                        'output pixels apart (e.g. 16).')
+    parser.add_argument('--rotate', action='store', type=int, choices=[0, 90, 180, 270],
+                        default=0, help='Rotate CCW as batch.py did before fitting.')
+    args = parser.parse_args()
+
+    source = lib.imread(args.image)
+    for i in range(args.rotate // 90):
+        source = np.rot90(source)
+
+    scale = args.scale
+    if scale is None and args.dpi:
+        source_dpi = int(round(source.shape[0] / 1100.0) * 100)
+        scale = args.dpi / source_dpi
+
+    spec = dewarp.RenderSpec(scale=scale, gray=args.gray, margin=args.margin,
+                             grid_step=args.grid_step)
+    for i, im in enumerate(render(source, args.models, spec)):
+        outfile = '{}{}.png'.format(args.output, i)
+        print('writing', outfile)
+        cv2.imwrite(outfile, im)
@@ -0,0 +1,75 @@
+from __future__ import division, print_function
+
+import argparse
+import numpy as np
+from numpy.linalg import norm
+
+import dewarp
+import lib
+
+# Candidate focal lengths, relative to the default one.
+FOCAL_SCALES = [0.6, 0.75, 0.9, 1.0, 1.15, 1.35, 1.6]
+
+# Final norm, theta and a_m of every page in images at focal_length.
+def fit_pages(images, focal_length, n_tries=6, processes=None):
+    norms, thetas, a_ms = [], [], []
+    for im in images:
+        for dewarper in dewarp.page_dewarpers(im, focal_length=focal_length):
+            opt_result = dewarper.fit(n_tries=n_tries, processes=processes)
+            theta, page_a_ms, _, _, _, _ = dewarp.unpack_args(opt_result.x,
+                                                              len(dewarper.pages),
+                                                              dewarper.family)
+            norms.append(norm(opt_result.fun))
+            thetas.append(theta)
+            a_ms.append(page_a_ms[0])
+
+    return np.array(norms), np.array(thetas), np.array(a_ms)
+
+# Profile the focal length: fit the calibration pages with free theta at
+# each candidate f and keep the f with the lowest median final norm. The rig
+# pose and surface are the medians of theta and a_m over that f's accepted
+# pages.
+def calibrate(images, focal_lengths=None, n_tries=6, processes=None):
+    if focal_lengths is None:
+        focal_lengths = [dewarp.f * scale for scale in FOCAL_SCALES]
+
+    best = None
+    for focal_length in focal_lengths:
+        norms, thetas, a_ms = fit_pages(images, focal_length, n_tries=n_tries,
+                                        processes=processes)
+        score = np.median(norms)
+        print('f = {:.1f}: median norm {:.3f}'.format(focal_length, score))
+        if best is None or score < best[0]:
+            best = score, focal_length, norms, thetas, a_ms
+
+    _, focal_length, norms, thetas, a_ms = best
+    accepted = norms < dewarp.ACCEPT_NORM
+    if accepted.any():
+        thetas, a_ms = thetas[accepted], a_ms[accepted]
+    else:
+        print('no page accepted; rig pose is unreliable.')
+
+    profile = dewarp.RigProfile(focal_length, np.median(thetas, axis=0),
+                                np.median(a_ms, axis=0))
+    return profile
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calibrate a fixed scanning rig.')
+    parser.add_argument('profile', action='store',
+                        help='Rig profile (JSON) to write.')
+    parser.add_argument('images', nargs='+',
+                        help='A handful of pages shot on the rig.')
+    parser.add_argument('--focal-lengths', action='store', type=float, nargs='+',
+                        help='Candidate focal lengths in pixels.')
+    parser.add_argument('--tries', action='store', type=int, default=6,
+                        help='Optimizer restarts per page.')
+    parser.add_argument('--restart-processes', action='store', type=int, default=1,
+                        help='Run optimizer restarts in this many threads.')
+    args = parser.parse_args()
+
+    images = [lib.imread(path) for path in args.images]
+    profile = calibrate(images, focal_lengths=args.focal_lengths,
+                        n_tries=args.tries, processes=args.restart_processes)
+    print('f:', profile.f)
+    print('theta:', profile.theta)
+    profile.save(args.profile)